@@ -0,0 +1,96 @@
+""" CTF - benchmarks/json_encoder.py
+
+Compares how long each JSON encoder takes to serialize responses shaped like the challenge listing
+and the scoreboard. The challenges are built by the same model and redaction code the routes use,
+without a database. Run from the repository root, with the app's environment, using
+`python -m benchmarks.json_encoder`.
+"""
+import json
+import timeit
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from ctf import app
+from ctf.encoder import StdJSONEncoder, OrjsonEncoder, orjson
+from ctf.models import Challenge, Flag, Hint
+from ctf.utils import redact_challenge
+
+# The options jsonify serializes responses with
+DUMPS_OPTIONS = {'separators': (',', ':'), 'sort_keys': app.config['JSON_SORT_KEYS']}
+
+# Stands in for UserProgress, which loads the user's solves and hints from the database
+Progress = namedtuple('Progress', ['solved', 'used_hints'])
+
+
+def public_challenge(challenge_id: int) -> dict:
+    """
+    :param challenge_id: Id of the challenge
+    :return: Unredacted challenge data, assembled like get_public_challenges does
+    """
+    challenge = Challenge("Challenge {}".format(challenge_id),
+                          "A description of challenge {}. ".format(challenge_id) * 10,
+                          "author", "submitter", None, None, "challenge{}.zip".format(challenge_id))
+    challenge.id = challenge_id
+    challenge.difficulty_name = "easy"
+    challenge.category_name = "web"
+    challenge.ts = datetime(2020, 1, 1) + timedelta(minutes=challenge_id)
+    challenge_data = challenge.to_dict(tags=["tag{}".format(tag) for tag in range(5)])
+    challenge_data['download'] = "https://s3.example.com/challenge{}.zip?X-Amz-Signature=0".format(
+        challenge_id)
+    challenge_data['flags'] = {}
+    for flag_id in range(challenge_id * 3, challenge_id * 3 + 3):
+        flag = Flag(100, "flag{{{}}}".format(flag_id), challenge_id)
+        flag.id = flag_id
+        flag_data = challenge_data['flags'][flag_id] = flag.to_dict()
+        flag_data['hints'] = {}
+        for hint_id in range(flag_id * 3, flag_id * 3 + 3):
+            hint = Hint(10, "A hint for flag {}".format(flag_id), flag_id)
+            hint.id = hint_id
+            flag_data['hints'][hint_id] = hint.to_dict()
+    return challenge_data
+
+
+def challenge_listing(count: int = 500) -> list:
+    """
+    :param count: Number of challenges in the listing
+    :return: Data shaped like the challenge listing, for a user who solved every other flag and
+        bought every other hint
+    """
+    progress = Progress(solved=set(range(0, count * 3, 2)), used_hints=set(range(0, count * 9, 2)))
+    return [redact_challenge(public_challenge(challenge_id), progress, False)
+            for challenge_id in range(count)]
+
+
+def scoreboard(count: int = 2000) -> dict:
+    """
+    :param count: Number of users on the scoreboard
+    :return: Data shaped like the output of GET /scores
+    """
+    return {"user{}".format(user): {'score': user * 7 % 1000, 'solved_flags': user % 40}
+            for user in range(count)}
+
+
+def main(number: int = 20):
+    """
+    Prints the time each encoder takes to serialize each payload
+
+    :param number: Number of times each payload is serialized
+    """
+    encoders = [StdJSONEncoder]
+    if orjson is None:
+        print("orjson isn't installed, only the standard library encoder will be measured")
+    else:
+        encoders.append(OrjsonEncoder)
+
+    for name, payload in (('challenges', challenge_listing()), ('scoreboard', scoreboard())):
+        for encoder in encoders:
+            seconds = timeit.timeit(
+                'dumps(payload, cls=encoder, **options)', number=number,
+                globals={'dumps': json.dumps, 'payload': payload, 'encoder': encoder,
+                         'options': DUMPS_OPTIONS})
+            print("{:<12} {:<16} {:8.2f} ms".format(
+                name, encoder.__name__, seconds / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
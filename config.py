@@ -1,5 +1,4 @@
 from os import environ, path, getcwd
-import requests
 
 APP_NAME = environ.get('CTF_APP_NAME', "CTF")
 HOST_NAME = environ.get('CTF_HOST_NAME', "localhost:5000")
@@ -14,12 +13,85 @@ SQLALCHEMY_POOL_RECYCLE = 500
 SQLALCHEMY_DATABASE_URI = environ.get('CTF_DATABASE_URI', 'sqlite:////{}'.format(
     path.join(getcwd(), 'data.db')))
 
+# Data versions behind the ETags of read endpoints and the in-process caches, shared by every
+# worker through this file. Only workers on the same host can share it, so run a single replica.
+DATA_VERSION_FILE = environ.get('CTF_DATA_VERSION_FILE', path.join(getcwd(), 'data_version.json'))
+
+# Cache of the challenge data shared by every user. The TTL must stay below the lifetime of the
+# presigned download URLs stored in it.
+PUBLIC_CHALLENGE_CACHE_SIZE = int(environ.get('CTF_PUBLIC_CHALLENGE_CACHE_SIZE', 1024))
+PUBLIC_CHALLENGE_CACHE_TTL = int(environ.get('CTF_PUBLIC_CHALLENGE_CACHE_TTL', 600))
+
+# Key that flags are HMACed with before they're stored and matched. Required, and kept separate
+# from SECRET_KEY so that neither can silently change the other. Run `flask migrate-flag-digests`
+# after changing it, or every stored digest stops matching.
+FLAG_DIGEST_KEY = environ.get('CTF_FLAG_DIGEST_KEY', None)
+
+# Cache of each challenge's flag digests, checked when a flag is submitted
+FLAG_CACHE_SIZE = int(environ.get('CTF_FLAG_CACHE_SIZE', 1024))
+
+# Token buckets limiting flag submissions, both per user and per user on each challenge. Rates are
+# submissions a minute, and bursts are how many can be made at once. The backend is 'memory' to
+# limit within each worker, 'sqlite' to share the limits between workers through a file, or 'none'.
+SOLVE_RATE_LIMIT_BACKEND = environ.get('CTF_SOLVE_RATE_LIMIT_BACKEND', 'memory')
+SOLVE_RATE_LIMIT_PATH = environ.get('CTF_SOLVE_RATE_LIMIT_PATH',
+                                    path.join(getcwd(), 'rate_limits.db'))
+# Seconds a submission waits for another worker to release the SQLite file before it's let through
+SOLVE_RATE_LIMIT_TIMEOUT = float(environ.get('CTF_SOLVE_RATE_LIMIT_TIMEOUT', 0.05))
+SOLVE_USER_RATE = float(environ.get('CTF_SOLVE_USER_RATE', 30))
+SOLVE_USER_BURST = int(environ.get('CTF_SOLVE_USER_BURST', 10))
+SOLVE_CHALLENGE_RATE = float(environ.get('CTF_SOLVE_CHALLENGE_RATE', 6))
+SOLVE_CHALLENGE_BURST = int(environ.get('CTF_SOLVE_CHALLENGE_BURST', 3))
+
+# JSON backend for responses: 'orjson', or 'json' for the standard library. Falls back to 'json'
+# if orjson isn't installed.
+JSON_BACKEND = environ.get('CTF_JSON_BACKEND', 'orjson')
+
+# Number of rows that streamed listings read from the database at a time
+STREAM_CHUNK_SIZE = int(environ.get('CTF_STREAM_CHUNK_SIZE', 100))
+
+# Width in seconds of the time buckets the score timeline is kept in. Run `flask rebuild-scores`
+# after changing it.
+SCORE_BUCKET_SECONDS = int(environ.get('CTF_SCORE_BUCKET_SECONDS', 300))
+
+# Live scoreboard feed: seconds between checks for new scores, seconds between keep-alive
+# comments, and how many events a client may fall behind by before it's sent a fresh snapshot
+SCORE_STREAM_INTERVAL = float(environ.get('CTF_SCORE_STREAM_INTERVAL', 1))
+SCORE_STREAM_HEARTBEAT = float(environ.get('CTF_SCORE_STREAM_HEARTBEAT', 15))
+SCORE_STREAM_QUEUE_SIZE = int(environ.get('CTF_SCORE_STREAM_QUEUE_SIZE', 100))
+# Seconds a ticket from POST /scores/stream/ticket can open the feed for. Tickets are signed with
+# SECRET_KEY, so they're only issued when it's set.
+SCORE_STREAM_TICKET_TTL = int(environ.get('CTF_SCORE_STREAM_TICKET_TTL', 60))
+
 # OpenID Connect SSO config
-OIDC_PUBLIC_KEY = \
-    b"-----BEGIN PUBLIC KEY-----\n" + \
-    bytes(requests.get("https://sso.csh.rit.edu/auth/realms/csh").json()['public_key'], 'UTF-8') + \
-    b"\n-----END PUBLIC KEY-----"
-OIDC_USERINFO_ENDPOINT = "https://sso.csh.rit.edu/auth/realms/csh/protocol/openid-connect/userinfo"
+# Signing keys are fetched from the JWKS URI on first use, unless a local PEM or JWKS file is given
+OIDC_JWKS_URI = environ.get('CTF_OIDC_JWKS_URI',
+                            "https://sso.csh.rit.edu/auth/realms/csh/protocol/openid-connect/certs")
+OIDC_KEY_FILE = environ.get('CTF_OIDC_KEY_FILE', None)
+OIDC_KEY_REFRESH_INTERVAL = int(environ.get('CTF_OIDC_KEY_REFRESH_INTERVAL', 3600))
+OIDC_USERINFO_ENDPOINT = environ.get(
+    'CTF_OIDC_USERINFO_ENDPOINT',
+    "https://sso.csh.rit.edu/auth/realms/csh/protocol/openid-connect/userinfo")
+# Take the username and groups from the verified token's claims, only calling the userinfo
+# endpoint when a claim is missing
+OIDC_CLAIMS_IDENTITY = environ.get('CTF_OIDC_CLAIMS_IDENTITY', 'true').lower() == 'true'
+
+# SSO HTTP client config. After SSO_FAILURE_THRESHOLD consecutive failures the SSO isn't called
+# again for SSO_RESET_TIMEOUT seconds.
+SSO_CONNECT_TIMEOUT = float(environ.get('CTF_SSO_CONNECT_TIMEOUT', 3.05))
+SSO_READ_TIMEOUT = float(environ.get('CTF_SSO_READ_TIMEOUT', 10))
+SSO_POOL_SIZE = int(environ.get('CTF_SSO_POOL_SIZE', 10))
+SSO_FAILURE_THRESHOLD = int(environ.get('CTF_SSO_FAILURE_THRESHOLD', 5))
+SSO_RESET_TIMEOUT = float(environ.get('CTF_SSO_RESET_TIMEOUT', 30))
+
+# Verified token cache config. Entries expire with the token they belong to.
+VERIFIED_TOKEN_CACHE_SIZE = int(environ.get('CTF_VERIFIED_TOKEN_CACHE_SIZE', 4096))
+
+# Userinfo cache config. Entries never outlive the token they were fetched with.
+USERINFO_CACHE_TTL = int(environ.get('CTF_USERINFO_CACHE_TTL', 60))
+USERINFO_CACHE_SIZE = int(environ.get('CTF_USERINFO_CACHE_SIZE', 4096))
+# Seconds past the TTL that an entry may be served while it's refreshed in the background
+USERINFO_CACHE_STALE = int(environ.get('CTF_USERINFO_CACHE_STALE', 0))
 
 # CORS config
 CORS_SUPPORTS_CREDENTIALS = True
@@ -34,3 +106,7 @@ S3_ACCESS_KEY_ID = environ.get("CTF_S3_ACCESS_KEY_ID", None)
 S3_SECRET_ACCESS_KEY = environ.get("CTF_S3_SECRET_ACCESS_KEY", None)
 S3_ENDPOINT_URL = environ.get("CTF_S3_ENDPOINT_URL", None)
 S3_BUCKET = environ.get("CTF_S3_BUCKET", None)
+
+# Presigned download URLs are cached, and re-signed once less than this many seconds are left
+PRESIGNED_URL_CACHE_SIZE = int(environ.get("CTF_PRESIGNED_URL_CACHE_SIZE", 1024))
+PRESIGNED_URL_MIN_LIFETIME = int(environ.get("CTF_PRESIGNED_URL_MIN_LIFETIME", 3600))
@@ -11,9 +11,14 @@ from flask_cors import CORS
 from boto3 import client
 
 import config
+from ctf.encoder import get_json_encoder
 
 app = Flask(__name__)
 app.config.from_object(config)
+if not app.config['FLAG_DIGEST_KEY']:
+    # Flags are stored and matched by their HMAC, which means nothing without a stable key
+    raise RuntimeError("CTF_FLAG_DIGEST_KEY must be set")
+app.json_encoder = get_json_encoder(app.config['JSON_BACKEND'])
 CORS(app)
 db = SQLAlchemy(app)
 auth = HTTPTokenAuth(scheme='Bearer')
@@ -23,7 +28,9 @@ s3 = client("s3",
             endpoint_url="https://s3.csh.rit.edu")
 
 # pylint: disable=wrong-import-position
-from ctf.routes import categories, difficulties, challenges, tags, solved, flags, hints, user, score
+from ctf.routes import categories, difficulties, challenges, tags, solved, flags, hints, user, \
+    score, stats
+from ctf import commands
 # pylint: enable=wrong-import-position
 
 
@@ -60,3 +67,4 @@ app.register_blueprint(flags)
 app.register_blueprint(hints)
 app.register_blueprint(user, url_prefix='/user')
 app.register_blueprint(score, url_prefix='/scores')
+app.register_blueprint(stats, url_prefix='/stats')
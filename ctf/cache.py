@@ -0,0 +1,257 @@
+""" CTF - cache.py
+
+Contains the caches and version counters used to avoid repeating expensive work across requests
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Tables known to exist, by database URL and table name. Only found tables are remembered, since
+# another process can create one at any time, e.g. by running `flask rebuild-search`.
+_found_tables = set()
+
+
+def token_digest(token: str) -> str:
+    """
+    Hashes a token so the raw credential is never used as a cache key
+
+    :param token: The token to hash
+    :return: Hex digest of the token
+    """
+    return hashlib.sha256(token.encode('UTF-8')).hexdigest()
+
+
+def table_exists(connection, table: str) -> bool:
+    """
+    Checks whether the database behind 'connection' has a table. Cached per database once the
+    table is found.
+
+    :param connection: A connection to the database
+    :param table: Name of the table
+    """
+    key = (str(connection.engine.url), table)
+    if key in _found_tables:
+        return True
+    if not connection.dialect.has_table(connection, table):
+        return False
+    _found_tables.add(key)
+    return True
+
+
+class TTLCache:
+    """A thread-safe, size-bounded LRU cache whose entries expire individually"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, stale_ttl: float = 0):
+        """
+        Creates a cache
+
+        :param maxsize: Maximum number of entries. The least recently used entry is evicted first.
+        :param ttl: Default number of seconds an entry is fresh for
+        :param stale_ttl: Number of seconds past freshness that an entry may still be served stale
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._counts = {'hits': 0, 'stale_hits': 0, 'misses': 0}
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """
+        Looks up an entry, including one that is stale but still within its grace period
+
+        :param key: Key of the entry
+        :return: None on a miss, otherwise a (value, fresh) tuple
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+            value, expires, stale_until = entry
+            if now >= stale_until:
+                del self._entries[key]
+                self._counts['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            if now < expires:
+                self._counts['hits'] += 1
+                return value, True
+            self._counts['stale_hits'] += 1
+            return value, False
+
+    def get(self, key, default=None):
+        """
+        Returns a fresh entry, or default if there isn't one
+
+        :param key: Key of the entry
+        :param default: Returned when the entry is missing or no longer fresh
+        """
+        found = self.lookup(key)
+        if found is None or not found[1]:
+            return default
+        return found[0]
+
+    def set(self, key, value, ttl: float = None, expires_at: float = None):
+        """
+        Stores an entry, evicting the least recently used entry if the cache is full
+
+        :param key: Key of the entry
+        :param value: Value to store
+        :param ttl: Seconds the entry is fresh for, instead of the cache's default
+        :param expires_at: Absolute unix time the entry must never be served past, stale or not
+        """
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        stale_until = expires + self.stale_ttl
+        if expires_at is not None:
+            expires = min(expires, expires_at)
+            stale_until = min(stale_until, expires_at)
+        if stale_until <= now:
+            return
+        with self._lock:
+            self._entries[key] = (value, expires, stale_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Removes an entry
+
+        :param key: Key of the entry
+        :return: The removed value, or default if it didn't exist
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        """
+        Removes every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def claim_refresh(self, key) -> bool:
+        """
+        Marks a key as being refreshed so only one refresh runs at a time
+
+        :param key: Key of the entry
+        :return: True if the caller should perform the refresh
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def release_refresh(self, key):
+        """
+        Marks a refresh started with claim_refresh as finished
+
+        :param key: Key of the entry
+        """
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self) -> dict:
+        """
+        :return: JSON serializable counters describing how the cache is performing
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        served = counts['hits'] + counts['stale_hits']
+        lookups = served + counts['misses']
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            **counts,
+            'hit_rate': served / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class VersionStore:
+    """
+    Counters that are bumped whenever the data they describe is written. When given a path, the
+    counters are kept in a JSON file so that every worker process on this host sees the same
+    versions. Processes on other hosts don't see them.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        Creates a VersionStore
+
+        :param path: File to keep the counters in. Counters are kept in memory if this is None.
+        """
+        self.path = path
+        self._versions = {'epoch': uuid.uuid4().hex} if path is None else {}
+        self._read_key = None
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> int:
+        """
+        :param key: Name of the counter
+        :return: The current version of the counter
+        """
+        return self._read().get(key, 0)
+
+    @property
+    def epoch(self) -> str:
+        """
+        :return: Identifier that changes whenever the counters are reset, e.g. the file is removed
+        """
+        return self._read().get('epoch', '')
+
+    def bump(self, *keys: str):
+        """
+        Increments counters
+
+        :param keys: Names of the counters to increment
+        :return: Every counter as this bump left it, including 'epoch'
+        """
+        with self._lock:
+            if self.path is None:
+                for key in keys:
+                    self._versions[key] = self._versions.get(key, 0) + 1
+                return dict(self._versions)
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._read_key = None
+                versions = dict(self._read())
+                versions.setdefault('epoch', uuid.uuid4().hex)
+                for key in keys:
+                    versions[key] = versions.get(key, 0) + 1
+                # Replace the file atomically so readers never need the lock
+                temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(temp_path, 'w') as temp_file:
+                    json.dump(versions, temp_file)
+                os.replace(temp_path, self.path)
+                return versions
+
+    def _read(self) -> dict:
+        """
+        Returns the counters, only re-reading the file when it has been replaced
+        """
+        if self.path is None:
+            return self._versions
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        read_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if read_key != self._read_key:
+            with open(self.path) as versions_file:
+                self._versions = json.load(versions_file)
+            self._read_key = read_key
+        return self._versions
@@ -0,0 +1,40 @@
+""" CTF - commands.py
+
+Contains maintenance commands run through the flask CLI, e.g. `flask rebuild-search`
+"""
+import click
+
+from ctf import app
+from ctf.search import rebuild_search_index
+from ctf.scoreboard import rebuild_scores
+from ctf.utils import migrate_flag_digests
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """
+    Creates the full-text search index over challenges if needed and repopulates it
+    """
+    rebuild_search_index()
+    print("Rebuilt the challenge search index")
+
+
+@app.cli.command('rebuild-scores')
+def rebuild_scores_command():
+    """
+    Creates the table of running score totals if needed and recalculates every user's score
+    """
+    rebuild_scores()
+    print("Rebuilt the score table")
+
+
+@app.cli.command('migrate-flag-digests')
+def migrate_flag_digests_command():
+    """
+    Adds the digest column to the flags table if needed and digests every flag with the current
+    FLAG_DIGEST_KEY
+    """
+    try:
+        print("Digested {} flags".format(migrate_flag_digests()))
+    except ValueError as clash_error:
+        raise click.ClickException(str(clash_error)) from clash_error
@@ -6,6 +6,12 @@ from flask import jsonify
 
 CTF_ADMINS = ["harmon"]
 
+# Claims that describe the token itself rather than the user, and so aren't part of userinfo
+TOKEN_ONLY_CLAIMS = frozenset([
+    "exp", "iat", "nbf", "jti", "iss", "aud", "typ", "azp", "nonce", "auth_time", "session_state",
+    "acr", "allowed-origins", "realm_access", "resource_access", "scope", "sid"
+])
+
 
 def collision():
     """
@@ -57,6 +63,28 @@ def invalid_mime_type(mime_type: str):
     }), 422
 
 
+def invalid_fields(error: Exception):
+    """
+    Return data when the user asks for fields that don't exist
+    :param error: Error describing the unknown fields
+    """
+    return jsonify({
+        'status': "error",
+        'message': str(error)
+    }), 400
+
+
+def rate_limited(retry_after: int):
+    """
+    Return data when the user has made too many requests
+    :param retry_after: Seconds until the user may try again
+    """
+    return jsonify({
+        'status': "error",
+        'message': "Too many attempts, try again in {} seconds".format(retry_after)
+    }), 429, {'Retry-After': str(retry_after)}
+
+
 def missing_body_parts(body_type: str, *args):
     """
     Return data when user is missing required parts of the request body
@@ -0,0 +1,71 @@
+""" CTF - encoder.py
+
+Contains the JSON encoders used for every response. The orjson backend is used when it's installed,
+otherwise responses fall back to the standard library's json module. Both serialize dates the same
+way Flask always has.
+
+orjson can't always produce what the json module would, so some payloads are handed to json:
+- With sort_keys, anything with non-str dict keys, since orjson would sort e.g. the int ids of
+  flags and hints as text, putting 10 before 2
+- Anything holding an integer wider than 64 bits, which orjson refuses
+The one difference left is that orjson writes NaN and infinite floats as null, where json writes
+the non-standard NaN and Infinity. No response holds such floats.
+"""
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdJSONEncoder(JSONEncoder):
+    """Flask's JSON encoder, extended to serialize models"""
+
+    def default(self, o):  # pylint: disable=method-hidden
+        """
+        Converts objects the json module can't serialize into ones it can
+
+        :param o: The object to convert
+        """
+        if hasattr(o, 'to_dict'):
+            return o.to_dict()
+        return super().default(o)
+
+
+class OrjsonEncoder(StdJSONEncoder):
+    """
+    Serializes with orjson, falling back to the json module for pretty printed output and for
+    payloads orjson would serialize differently
+    """
+
+    def encode(self, o) -> str:
+        """
+        :param o: The object to serialize
+        :return: JSON text
+        """
+        if self.indent is not None:
+            return super().encode(o)
+        # Dates are passed through to default() so they're formatted like StdJSONEncoder does
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            # Without OPT_NON_STR_KEYS, orjson raises on the keys it would sort differently
+            option |= orjson.OPT_SORT_KEYS
+        else:
+            option |= orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(o, default=self.default, option=option).decode('UTF-8')
+        except orjson.JSONEncodeError:
+            return super().encode(o)
+
+
+def get_json_encoder(backend: str):
+    """
+    Picks the JSON encoder for a backend
+
+    :param backend: 'orjson' or 'json'
+    :return: The encoder class. StdJSONEncoder if orjson was asked for but isn't installed.
+    """
+    if backend == 'orjson' and orjson is not None:
+        return OrjsonEncoder
+    return StdJSONEncoder
@@ -0,0 +1,118 @@
+""" CTF - etags.py
+
+Contains the data versions that back conditional GETs. Every committed write bumps a version:
+solves and hint purchases bump the version of the user who made them and the scores version,
+anything else bumps the version of the shared data.
+
+The versions are kept in a file locked with fcntl (DATA_VERSION_FILE), so they only stay consistent
+between workers on one host. The ETags, and every in-process cache keyed by a version (the public
+challenge cache, the flag digest cache, the leaderboard and the score feed), assume the API runs as
+a single replica; a second host would keep serving its own stale data and ETags.
+"""
+import time
+from functools import wraps, partial
+
+from flask import request, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from ctf import app
+from ctf.cache import VersionStore, token_digest
+from ctf.models import Solved, UsedHint
+
+data_versions = VersionStore(app.config['DATA_VERSION_FILE'])
+
+DATA_KEY = 'data'
+# Bumped by anything that changes a score, so in-process copies of the scoreboard can tell
+SCORES_KEY = 'scores'
+
+
+def progress_key(username: str) -> str:
+    """
+    :param username: The user whose progress version is wanted
+    :return: Name of the version counter of a user's solves and purchased hints
+    """
+    return 'user:' + username
+
+
+def make_etag(username: str = None, signed_urls: bool = False) -> str:
+    """
+    Builds an ETag from the shared data version and, if given, the user's progress version
+
+    :param username: User the response was built for, if it depends on who's asking
+    :param signed_urls: Whether the response has presigned download URLs. The ETag then changes
+        at least as often as the shortest lifetime a served URL can have left, so a client is
+        never told to keep a URL that has expired.
+    :return: The ETag
+    """
+    etag = '{}-{}'.format(data_versions.epoch, data_versions.get(DATA_KEY))
+    if username:
+        etag += '-{}-{}'.format(token_digest(username)[:16],
+                                data_versions.get(progress_key(username)))
+    if signed_urls:
+        # URLs are re-signed once this little lifetime is left, and may then sit in the public
+        # challenge cache for up to its TTL
+        window = app.config['PRESIGNED_URL_MIN_LIFETIME'] - app.config['PUBLIC_CHALLENGE_CACHE_TTL']
+        etag += '-{}'.format(int(time.time() // max(window, 1)))
+    return etag
+
+
+def conditional_get(func=None, signed_urls: bool = False):
+    """
+    Adds an ETag to successful responses, and returns 304 without calling the wrapped route when
+    the client's If-None-Match already has it. Should wrap a route under expose_userinfo if the
+    response depends on who's asking. Routes that return presigned download URLs should use
+    @conditional_get(signed_urls=True).
+    """
+    if func is None:
+        return partial(conditional_get, signed_urls=signed_urls)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        username = None
+        if 'userinfo' in kwargs:
+            username = kwargs['userinfo'].get('preferred_username')
+        etag = make_etag(username, signed_urls)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return wrapper
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_written_versions(session, flush_context):
+    # pylint: disable=unused-argument
+    """
+    Records which versions the flushed writes affect, to be bumped once they're committed
+    """
+    keys = session.info.setdefault('version_keys', set())
+    for instance in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(instance, (Solved, UsedHint)):
+            keys.add(progress_key(instance.username))
+            keys.add(SCORES_KEY)
+        else:
+            keys.add(DATA_KEY)
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_written_versions(session):
+    """
+    Bumps the versions affected by a committed transaction. The versions it made are left in
+    session.info['bumped_versions'] for the after_commit listeners registered after this one.
+    """
+    keys = session.info.pop('version_keys', None)
+    session.info['bumped_versions'] = data_versions.bump(*keys) if keys else {}
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_written_versions(session):
+    """
+    Forgets the versions recorded for a transaction that was rolled back
+    """
+    session.info.pop('version_keys', None)
@@ -0,0 +1,200 @@
+""" CTF - feed.py
+
+Contains the publisher behind the live scoreboard feed. Each worker runs one background thread
+that watches the scores version, works out what changed, and fans the changes out to every
+connected client, so the database is read once per change instead of once per client. Under
+gunicorn's gevent workers the thread, queues and sleeps are all cooperative.
+"""
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import json
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from ctf import app, db
+from ctf.etags import data_versions, SCORES_KEY
+from ctf.models import Solved, Flag
+from ctf.scoreboard import leaderboard
+
+# Solves are found by their timestamp, which is set before they're committed. Looking back this
+# far catches solves whose transactions took a while to commit.
+SOLVE_LOOKBACK = timedelta(seconds=60)
+
+TICKET_SALT = 'score-stream'
+
+
+def format_event(name: str, data) -> str:
+    """
+    :param name: Name of the Server-Sent Event
+    :param data: JSON serializable data of the event
+    :return: The event, formatted to be written to a text/event-stream response
+    """
+    return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+
+def issue_stream_ticket(username: str) -> str:
+    """
+    Signs a short-lived ticket that opens the score stream. Browsers' EventSource can't send an
+    Authorization header, so it passes one of these in the URL instead.
+
+    :param username: The user the ticket is for
+    :return: The ticket
+    """
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=TICKET_SALT).dumps(username)
+
+
+def check_stream_ticket(ticket: str) -> bool:
+    """
+    :param ticket: A ticket from issue_stream_ticket
+    :return: Whether the ticket is genuine and younger than SCORE_STREAM_TICKET_TTL seconds
+    """
+    if not app.config['SECRET_KEY']:
+        return False
+    try:
+        URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=TICKET_SALT).loads(
+            ticket, max_age=app.config['SCORE_STREAM_TICKET_TTL'])
+    except BadSignature:
+        return False
+    return True
+
+
+class ScoreFeed:  # pylint: disable=too-many-instance-attributes
+    """Publishes scoreboard changes and new solves to every subscribed client of this worker"""
+
+    def __init__(self, interval: float = 1, queue_size: int = 100):
+        """
+        Creates a ScoreFeed
+
+        :param interval: Seconds between checks for new scores
+        :param queue_size: Number of events a client may fall behind by before it's sent a fresh
+            snapshot instead
+        """
+        self.interval = interval
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._version = None
+        self._board = {}
+        self._watermark = None
+        self._seen_solves = {}
+        self._publisher = None
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> queue.Queue:
+        """
+        Adds a client. Must be called with an app context.
+
+        :return: Queue of formatted events for the client, starting with a snapshot of the board
+        """
+        subscriber = queue.Queue(self.queue_size)
+        with self._lock:
+            if self._version is None:
+                self._reset()
+            subscriber.put_nowait(self._snapshot())
+            self._subscribers.add(subscriber)
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish_forever, daemon=True)
+                self._publisher.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        """
+        Removes a client
+
+        :param subscriber: The queue returned by subscribe
+        """
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                # Nothing is tracked while nobody is listening, so start over on the next client
+                self._version = None
+
+    def _reset(self):
+        """
+        Starts tracking the board from its current state. Must be called holding the lock.
+        """
+        self._version = (data_versions.epoch, data_versions.get(SCORES_KEY))
+        self._board = {entry['username']: entry for entry in leaderboard.top()}
+        self._watermark = datetime.utcnow()
+        self._seen_solves = {}
+        # Solves made before now are already part of the board
+        self._new_solves()
+
+    def _snapshot(self) -> str:
+        """
+        :return: Event with the whole board as it's currently tracked
+        """
+        return format_event('snapshot', list(self._board.values()))
+
+    def _publish_forever(self):
+        """
+        Checks for changes every 'interval' seconds. Runs in the publisher thread.
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context(), self._lock:
+                    if self._subscribers:
+                        self._publish()
+            except Exception as publish_error:  # pylint: disable=broad-except
+                print(publish_error)
+
+    def _publish(self):
+        """
+        Sends every subscriber what changed since the last check. Must be called holding the lock.
+        """
+        version = (data_versions.epoch, data_versions.get(SCORES_KEY))
+        if version == self._version:
+            return
+        self._version = version
+
+        events = []
+        solves = self._new_solves()
+        if solves:
+            events.append(format_event('solves', solves))
+        board = {entry['username']: entry for entry in leaderboard.top()}
+        changed = [entry for username, entry in board.items() if self._board.get(username) != entry]
+        removed = [username for username in self._board if username not in board]
+        self._board = board
+        if changed or removed:
+            events.append(format_event('scores', {'changed': changed, 'removed': removed}))
+
+        for subscriber in self._subscribers:
+            try:
+                for formatted in events:
+                    subscriber.put_nowait(formatted)
+            except queue.Full:
+                # The client has fallen behind, so it's started over from the current board
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(self._snapshot())
+
+    def _new_solves(self) -> list:
+        """
+        :return: The solves committed since the last check, oldest first
+        """
+        solves = db.session.query(
+            Solved.username, Solved.flag_id, Flag.challenge_id, Flag.point_value, Solved.ts
+        ).join(Flag, Solved.flag_id == Flag.id).filter(
+            Solved.ts > self._watermark - SOLVE_LOOKBACK).order_by(Solved.ts)
+        new_solves = []
+        for username, flag_id, challenge_id, point_value, solved_at in solves:
+            if (flag_id, username) in self._seen_solves:
+                continue
+            self._seen_solves[(flag_id, username)] = solved_at
+            self._watermark = max(self._watermark, solved_at)
+            new_solves.append({
+                'username': username,
+                'flag_id': flag_id,
+                'challenge_id': challenge_id,
+                'point_value': point_value,
+                'ts': solved_at
+            })
+        self._seen_solves = {key: solved_at for key, solved_at in self._seen_solves.items()
+                             if solved_at > self._watermark - SOLVE_LOOKBACK}
+        return new_solves
+
+
+score_feed = ScoreFeed(interval=app.config['SCORE_STREAM_INTERVAL'],
+                       queue_size=app.config['SCORE_STREAM_QUEUE_SIZE'])
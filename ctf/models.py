@@ -2,12 +2,23 @@
 
 This module contains the models for each table in the database
 """
+import hashlib
+import hmac
 from datetime import datetime
 
-from sqlalchemy import Column, ForeignKey, Integer, SmallInteger, Text, DateTime, Boolean
+from sqlalchemy import Column, ForeignKey, Integer, SmallInteger, Text, DateTime, Boolean, Index
 from sqlalchemy.orm import relationship
 
-from ctf import db
+from ctf import db, app
+
+
+def flag_digest(flag: str) -> str:
+    """
+    :param flag: A flag, or an attempt at one
+    :return: HMAC of the flag under FLAG_DIGEST_KEY, which flags are looked up and matched by
+    """
+    return hmac.new(app.config['FLAG_DIGEST_KEY'].encode('UTF-8'), flag.encode('UTF-8'),
+                    hashlib.sha256).hexdigest()
 
 
 class Category(db.Model):
@@ -105,6 +116,8 @@ class Challenge(db.Model):
     """Challenges have a brief description, and then flags to be obtained!"""
 
     __tablename__ = 'challenges'
+    # Backs the keyset pagination of the challenge listing
+    __table_args__ = (Index('ix_challenges_ts_id', 'ts', 'id'),)
 
     id = Column(Integer, primary_key=True)
     difficulty_name = Column(ForeignKey('difficulties.name'), nullable=False, index=True)
@@ -114,7 +127,7 @@ class Challenge(db.Model):
     author = Column(Text, nullable=False)
     submitter = Column(Text, nullable=False)
     filename = Column(Text)
-    ts = Column(DateTime, default=datetime.utcnow().isoformat)
+    ts = Column(DateTime, default=datetime.utcnow)
 
     tags = db.relationship('ChallengeTag', backref='challenges')
     category = relationship('Category')
@@ -161,8 +174,9 @@ class Challenge(db.Model):
         db.session.commit()
         return new_challenge.to_dict()
 
-    def to_dict(self) -> dict:
+    def to_dict(self, tags: list = None) -> dict:
         """
+        :param tags: Names of this Challenge's tags, if they've already been loaded
         :return: JSON serializable representation of a Challenge
         """
         return {
@@ -171,7 +185,7 @@ class Challenge(db.Model):
             'category': self.category_name,
             'title': self.title,
             'description': self.description,
-            'tags': [tag.to_dict()['tag'] for tag in self.tags],
+            'tags': [tag.tag for tag in self.tags] if tags is None else tags,
             'author': self.author,
             'submitter': self.submitter,
             'ts': self.ts,
@@ -235,11 +249,17 @@ class Flag(db.Model):
     """Flags are the objectives of a Challenge. Each has a point value and belongs to a Challenge"""
 
     __tablename__ = 'flags'
+    __table_args__ = (
+        Index('ix_flags_challenge_digest', 'challenge_id', 'digest', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     point_value = Column(SmallInteger, nullable=False)
     flag = Column(Text, nullable=False)
     challenge_id = Column(ForeignKey('challenges.id'), nullable=False, index=True)
+    # Nullable only so the column can be added to existing tables by `flask migrate-flag-digests`,
+    # which must run before this version serves requests
+    digest = Column(Text)
 
     challenge = relationship('Challenge')
     hints = relationship('Hint')
@@ -255,6 +275,7 @@ class Flag(db.Model):
         """
         self.point_value = point_value
         self.flag = flag
+        self.digest = flag_digest(flag)
         self.challenge_id = challenge_id
 
     @classmethod
@@ -347,7 +368,7 @@ class Solved(db.Model):
 
     flag_id = Column(ForeignKey('flags.id'), primary_key=True, nullable=False, index=True)
     username = Column(Text, primary_key=True, nullable=False)
-    ts = Column(DateTime, default=datetime.utcnow().isoformat, nullable=False)
+    ts = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     flag = relationship('Flag')
 
@@ -399,10 +420,14 @@ class UsedHint(db.Model):
 
     hint_id = Column(ForeignKey('hints.id'), primary_key=True, nullable=False, index=True)
     username = Column(Text, primary_key=True, nullable=False)
-    ts = Column(DateTime, default=datetime.utcnow().isoformat, nullable=False)
+    ts = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     hint = relationship('Hint')
 
+    # Set when the hint's cost was already taken from user_scores, so inserting the purchase
+    # doesn't take it again
+    prepaid = False
+
     def __init__(self, hint_id: int, username: str):
         """
         Initializes a new used hint relation
@@ -435,3 +460,49 @@ class UsedHint(db.Model):
             'username': self.username,
             'ts': self.ts
         }
+
+
+class UserScore(db.Model):
+    """The running total of a user's score, kept up to date by ctf.scoreboard"""
+
+    __tablename__ = 'user_scores'
+    # Backs reading the top of the scoreboard
+    __table_args__ = (Index('ix_user_scores_score', 'score', 'solved_flags'),)
+
+    username = Column(Text, primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+    solved_flags = Column(Integer, nullable=False, default=0)
+    last_solve_ts = Column(DateTime)
+
+    def to_dict(self) -> dict:
+        """
+        :return: JSON serializable representation of a UserScore
+        """
+        return {
+            'username': self.username,
+            'score': self.score,
+            'solved_flags': self.solved_flags,
+            'last_solve_ts': self.last_solve_ts
+        }
+
+
+class ScoreBucket(db.Model):
+    """A user's running score at the end of a time bucket, kept up to date by ctf.scoreboard"""
+
+    __tablename__ = 'score_buckets'
+
+    username = Column(Text, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+    solved_flags = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self) -> dict:
+        """
+        :return: JSON serializable representation of a ScoreBucket
+        """
+        return {
+            'username': self.username,
+            'bucket': self.bucket,
+            'score': self.score,
+            'solved_flags': self.solved_flags
+        }
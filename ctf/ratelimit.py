@@ -0,0 +1,208 @@
+""" CTF - ratelimit.py
+
+Contains the token buckets that limit how quickly flags can be submitted. A bucket holds up to
+'burst' tokens and is refilled at 'rate' tokens a second; each submission takes a token from every
+bucket it counts against, and is turned away if any of them is empty. Buckets are kept either in
+each worker's memory or in a SQLite file shared by every worker.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import g
+
+from ctf import app
+from ctf.cache import TTLCache, token_digest
+from ctf.constants import rate_limited
+
+
+def refill(tokens: float, updated: float, now: float, rate: float, burst: int) -> float:
+    """
+    :param tokens: Tokens the bucket held at 'updated', or None if it's new
+    :param updated: Unix time the bucket was last written
+    :param now: The current unix time
+    :param rate: Tokens added to the bucket each second
+    :param burst: Most tokens the bucket can hold
+    :return: Tokens the bucket holds now
+    """
+    if tokens is None:
+        return float(burst)
+    return min(float(burst), tokens + max(now - updated, 0) * rate)
+
+
+def take_tokens(held: list, limits: list) -> float:
+    """
+    Works out whether a token can be taken from every bucket
+
+    :param held: Tokens currently in each bucket
+    :param limits: The (key, rate, burst) of each bucket, in the same order
+    :return: 0 if the tokens can be taken, otherwise the seconds until they can
+    """
+    return max([(1 - tokens) / rate for tokens, (_, rate, _) in zip(held, limits) if tokens < 1],
+               default=0)
+
+
+class MemoryBuckets:
+    """Token buckets kept in this worker's memory, so each worker limits on its own"""
+
+    def __init__(self, maxsize: int = 65536):
+        """
+        Creates a MemoryBuckets
+
+        :param maxsize: Most buckets kept at once. A bucket that's dropped starts over full.
+        """
+        self._buckets = TTLCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def acquire(self, limits: list) -> float:
+        """
+        Takes a token from every bucket, or from none of them if any is empty
+
+        :param limits: The (key, rate, burst) of each bucket
+        :return: 0 if the tokens were taken, otherwise the seconds until they can be
+        """
+        now = time.time()
+        with self._lock:
+            held = []
+            for key, rate, burst in limits:
+                tokens, updated = self._buckets.get(key, (None, now))
+                held.append(refill(tokens, updated, now, rate, burst))
+            retry_after = take_tokens(held, limits)
+            if not retry_after:
+                for tokens, (key, rate, burst) in zip(held, limits):
+                    # Once it's full again the bucket is the same as a new one, so it can expire
+                    self._buckets.set(key, (tokens - 1, now), ttl=(burst - tokens + 1) / rate)
+            return retry_after
+
+
+class SQLiteBuckets:
+    """Token buckets kept in a SQLite file, so that every worker on a host shares the limits"""
+
+    # Buckets that have refilled are deleted after this many acquisitions
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, path: str, timeout: float = 0.05):
+        """
+        Creates a SQLiteBuckets
+
+        :param path: The SQLite file to keep the buckets in. Created if it doesn't exist.
+        :param timeout: Seconds to wait for another worker's write lock before letting the
+            submission through
+        """
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+        self._acquisitions = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Must be called with the lock held. The connection is shared by every thread and greenlet
+        in the worker, and is only opened again in a forked child.
+
+        :return: This worker's connection to the file, in autocommit mode
+        """
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, "
+                               "tokens REAL NOT NULL, updated REAL NOT NULL, full REAL NOT NULL)")
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def acquire(self, limits: list) -> float:
+        """
+        Takes a token from every bucket, or from none of them if any is empty. Fails open: if the
+        file can't be used, the submission is let through.
+
+        :param limits: The (key, rate, burst) of each bucket
+        :return: 0 if the tokens were taken, otherwise the seconds until they can be
+        """
+        with self._lock:
+            try:
+                return self._acquire(self._connect(), limits)
+            except sqlite3.Error as sqlite_error:
+                print(sqlite_error)
+                return 0
+
+    def _acquire(self, connection: sqlite3.Connection, limits: list) -> float:
+        """
+        :param connection: This worker's connection to the file
+        :param limits: The (key, rate, burst) of each bucket
+        :return: 0 if the tokens were taken, otherwise the seconds until they can be
+        """
+        # Takes the file's write lock up front, so workers read and write buckets one at a time
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            held = []
+            for key, rate, burst in limits:
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?",
+                                         (key,)).fetchone()
+                held.append(refill(*(row or (None, now)), now, rate, burst))
+            retry_after = take_tokens(held, limits)
+            if not retry_after:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated, full) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(key, tokens - 1, now, now + (burst - tokens + 1) / rate)
+                     for tokens, (key, rate, burst) in zip(held, limits)])
+            self._acquisitions += 1
+            if self._acquisitions % self.PRUNE_INTERVAL == 0:
+                connection.execute("DELETE FROM buckets WHERE full < ?", (now,))
+            connection.execute("COMMIT")
+        finally:
+            # Only set if something above failed; the error raised there is the one passed on
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+        return retry_after
+
+
+def get_buckets(backend: str, path: str = None, timeout: float = 0.05):
+    """
+    Picks the token buckets for a backend
+
+    :param backend: 'memory', 'sqlite', or 'none' to not limit at all
+    :param path: The SQLite file to use with the 'sqlite' backend
+    :param timeout: Seconds the 'sqlite' backend waits for the file's write lock
+    :return: The buckets, or None if nothing should be limited
+    """
+    if backend == 'sqlite':
+        return SQLiteBuckets(path, timeout)
+    if backend == 'memory':
+        return MemoryBuckets()
+    return None
+
+
+submission_buckets = get_buckets(app.config['SOLVE_RATE_LIMIT_BACKEND'],
+                                 app.config['SOLVE_RATE_LIMIT_PATH'],
+                                 app.config['SOLVE_RATE_LIMIT_TIMEOUT'])
+
+
+def limit_submissions(func):
+    """
+    Turns flag submissions away with a 429 once the user has made too many, overall or on the
+    challenge. Only needs the verified token, so it must be called in conjunction with
+    auth.login_required and should wrap expose_userinfo, turning requests away before the
+    userinfo lookup and any database work.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if submission_buckets is None:
+            return func(*args, **kwargs)
+        claims = getattr(g, 'token_claims', None) or {}
+        user = claims.get('preferred_username') or token_digest(g.token)
+        retry_after = submission_buckets.acquire([
+            ('user:' + user, app.config['SOLVE_USER_RATE'] / 60,
+             app.config['SOLVE_USER_BURST']),
+            ('challenge:{}:{}'.format(kwargs.get('challenge_id'), user),
+             app.config['SOLVE_CHALLENGE_RATE'] / 60, app.config['SOLVE_CHALLENGE_BURST'])
+        ])
+        if retry_after:
+            return rate_limited(math.ceil(retry_after))
+        return func(*args, **kwargs)
+    return wrapper
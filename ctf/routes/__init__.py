@@ -12,3 +12,4 @@ from .flags import flags_bp as flags
 from .hints import hints_bp as hints
 from .user import user_bp as user
 from .scores import score_bp as score
+from .stats import stats_bp as stats
@@ -7,6 +7,7 @@ from flask import Blueprint, jsonify, request
 from ctf import auth
 from ctf.models import Category, Challenge
 from ctf.utils import has_json_args
+from ctf.etags import conditional_get
 from ctf.constants import not_found, collision
 
 categories_bp = Blueprint('categories', __name__)
@@ -14,6 +15,7 @@ categories_bp = Blueprint('categories', __name__)
 
 @categories_bp.route('', methods=['GET'])
 @auth.login_required
+@conditional_get
 def get_all_categories():
     """
     Get all categories
@@ -50,6 +52,7 @@ def create_new_category():
 
 @categories_bp.route('/<category_name>', methods=['GET'])
 @auth.login_required
+@conditional_get
 def get_category(category_name: str):
     """
     Operations relating to a single category
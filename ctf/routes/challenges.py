@@ -5,17 +5,22 @@ Contains the routes pertaining to the retrieval, creation, and removal of challe
 import os.path
 import threading
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, json
 from sqlalchemy import desc, asc
+from sqlalchemy.orm import load_only
 import magic
 from werkzeug.utils import secure_filename
 
 from ctf import auth, app
 from ctf.models import Challenge, Difficulty, Category
-from ctf.utils import delete_flags, delete_challenge_tags, get_all_challenge_data, expose_userinfo,\
-    is_ctf_admin, has_formdata_args, s3_upload_and_create_challenge, delete_s3_object
+from ctf.utils import delete_flags, delete_challenge_tags, get_challenges_data, expose_userinfo,\
+    is_ctf_admin, has_formdata_args, s3_upload_and_create_challenge, delete_s3_object, \
+    encode_challenge_cursor, decode_challenge_cursor, parse_challenge_fields, \
+    challenge_load_columns, iter_challenges_data, stream_json, stream_json_array
+from ctf.search import search_challenges
+from ctf.etags import conditional_get
 from ctf.constants import not_found, no_username, not_authorized, invalid_mime_type, \
-    missing_body_parts, collision
+    missing_body_parts, collision, invalid_fields
 
 challenges_bp = Blueprint('challenges', __name__)
 
@@ -23,9 +28,20 @@ challenges_bp = Blueprint('challenges', __name__)
 @challenges_bp.route('', methods=['GET'])
 @auth.login_required
 @expose_userinfo
+@conditional_get(signed_urls=True)
 def all_challenges(**kwargs):
     """
     Get all challenges
+
+    The 'fields' URL parameter is a comma-separated list of the fields to return. Tags, flags,
+    hints and download links are only loaded when they're asked for.
+
+    The 'search' URL parameter is matched against the full-text index, and results are ranked by
+    relevance unless 'sort_by' is given.
+
+    Passing the 'cursor' URL parameter (empty for the first page) switches to keyset pagination.
+    The response is then an object with the page in 'challenges' and the cursor of the next page
+    in 'next_cursor', which is null on the last page. Pages hold from 1 to 100 challenges.
     """
     # 'limit' and 'offset' URL parameters can be used to modify which challenges are returned
     try:
@@ -36,43 +52,110 @@ def all_challenges(**kwargs):
         offset = int(request.args.get('offset', default=1))
     except ValueError:
         offset = 1
+    try:
+        fields = parse_challenge_fields(request.args.get('fields'))
+    except ValueError as fields_error:
+        return invalid_fields(fields_error)
+    cursor = request.args.get('cursor')
+    after = None
+    if cursor:
+        try:
+            after = decode_challenge_cursor(cursor)
+        except ValueError:
+            return jsonify({
+                'status': "error",
+                'message': "Invalid cursor"
+            }), 400
+
+    current_user = kwargs['userinfo'].get('preferred_username')
+    if not current_user:
+        return no_username()
+
+    challenges, order_op = filter_challenges(fields, cursor is not None)
+    if cursor is None:
+        # 'offset' is a page number, like it was when this used paginate()
+        if limit < 0:
+            limit = 20
+        challenges = challenges.limit(limit).offset((max(offset, 1) - 1) * limit)
+        return stream_json(stream_json_array(iter_challenges_data(
+            challenges.yield_per(app.config['STREAM_CHUNK_SIZE']), current_user, fields
+        ))), 200
+
+    # A page always holds at least one challenge, so that it has a cursor to continue from, and
+    # at most 100, so that one request can't read the whole table
+    return stream_json(challenge_page_body(challenges, order_op, after, min(max(limit, 1), 100),
+                                           current_user, fields)), 200
+
+
+def filter_challenges(fields: list, keyset: bool) -> tuple:
+    """
+    Builds the query for the challenge listing from the request's URL parameters
+
+    :param fields: The fields that will be returned, from parse_challenge_fields
+    :param keyset: Whether the listing is paginated by cursor, which only follows (ts, id)
+    :return: The ordered query, and the asc or desc its (ts, id) order was built with
+    """
     search_query = request.args.get('search')
     sort_by = request.args.get('sort_by')
     order_by = request.args.get('order_by')
 
+    challenges = Challenge.query
+    if columns := challenge_load_columns(fields):
+        challenges = challenges.options(load_only(*columns))
     # Category and Difficulty parameters are a comma-separated list of categories/difficulties
-    categories = []
-    difficulties = []
     if category_names := request.args.get('categories'):
-        categories = category_names.split(',')
+        challenges = challenges.filter(Challenge.category_name.in_(category_names.split(',')))
     if difficulty_names := request.args.get('difficulties'):
-        difficulties = difficulty_names.split(',')
-
-    current_user = kwargs['userinfo'].get('preferred_username')
-    if not current_user:
-        return no_username()
-
-    challenges = Challenge.query
-    if categories:
-        challenges = challenges.filter(Challenge.category_name.in_(categories))
-    if difficulties:
-        challenges = challenges.filter(Challenge.difficulty_name.in_(difficulties))
+        challenges = challenges.filter(Challenge.difficulty_name.in_(difficulty_names.split(',')))
+    relevance = None
     if search_query:
-        challenges = challenges.filter(
-            getattr(Challenge, 'description').ilike(f'%{search_query}%') |
-            getattr(Challenge, 'title').ilike(f'%{search_query}%') |
-            getattr(Challenge, 'submitter').ilike(f'%{search_query}%')
-        )
+        challenges, relevance = search_challenges(challenges, search_query)
     order_op = asc if order_by == "asc" else desc
-    if sort_by in ('date', 'ts'):
-        sort_query = order_op(Challenge.ts)
-    else:
-        sort_query = order_op(Challenge.ts)
-    challenges = challenges.order_by(sort_query).paginate(offset, limit, error_out=False).items
+    # Searches are ranked by relevance unless a sort was asked for
+    if relevance is not None and not sort_by and not keyset:
+        challenges = challenges.order_by(relevance)
+    return challenges.order_by(order_op(Challenge.ts), order_op(Challenge.id)), order_op
+
 
-    return jsonify([
-        get_all_challenge_data(challenge.id, current_user) for challenge in challenges
-    ]), 200
+def challenge_page_body(challenges, order_op, after: tuple, limit: int, current_user: str,
+                        fields: list):
+    """
+    Streams one keyset page of the challenge listing
+
+    :param challenges: The ordered query from filter_challenges
+    :param order_op: The asc or desc the query is ordered by
+    :param after: The (ts, id) of the challenge the page starts after, or None for the first page
+    :param limit: Number of challenges on the page, from 1 to 100
+    :param current_user: The user the page is for
+    :param fields: The fields to return
+    :return: Generator of the JSON body's pieces
+    """
+    if after:
+        after_ts, after_id = after
+        if order_op is asc:
+            challenges = challenges.filter(
+                (Challenge.ts > after_ts) | ((Challenge.ts == after_ts) & (Challenge.id > after_id))
+            )
+        else:
+            challenges = challenges.filter(
+                (Challenge.ts < after_ts) | ((Challenge.ts == after_ts) & (Challenge.id < after_id))
+            )
+    page = {'last': None, 'more': False}
+
+    def page_challenges():
+        # Fetch one extra row to find out whether there's another page
+        rows = challenges.limit(limit + 1).yield_per(app.config['STREAM_CHUNK_SIZE'])
+        for index, challenge in enumerate(rows):
+            if index == limit:
+                page['more'] = True
+                break
+            page['last'] = challenge
+            yield challenge
+
+    yield '{"challenges":'
+    yield from stream_json_array(iter_challenges_data(page_challenges(), current_user, fields))
+    next_cursor = encode_challenge_cursor(page['last']) if page['more'] else None
+    yield ',"next_cursor":' + json.dumps(next_cursor) + '}'
 
 
 @challenges_bp.route('', methods=['POST'])
@@ -133,14 +216,24 @@ def create_challenge(**kwargs):
 @challenges_bp.route('/<int:challenge_id>', methods=['GET'])
 @auth.login_required
 @expose_userinfo
+@conditional_get(signed_urls=True)
 def single_challenge(challenge_id: int, **kwargs):
     """
     Operations pertaining to a single challenge
 
-    :GET: Get the challenge identified by 'challenge_id'
+    :GET: Get the challenge identified by 'challenge_id'. Takes the same 'fields' URL parameter as
+        the challenge listing.
     :DELETE: Delete the challenge identified by 'challenge_id'
     """
-    challenge = Challenge.query.filter_by(id=challenge_id).first()
+    try:
+        fields = parse_challenge_fields(request.args.get('fields'))
+    except ValueError as fields_error:
+        return invalid_fields(fields_error)
+
+    challenge = Challenge.query
+    if columns := challenge_load_columns(fields):
+        challenge = challenge.options(load_only(*columns))
+    challenge = challenge.filter_by(id=challenge_id).first()
     if not challenge:
         return not_found()
 
@@ -148,7 +241,7 @@ def single_challenge(challenge_id: int, **kwargs):
     if not current_user:
         return no_username()
 
-    return jsonify(get_all_challenge_data(challenge.id, current_user)), 200
+    return jsonify(get_challenges_data([challenge], current_user, fields)[0]), 200
 
 
 @challenges_bp.route('/<int:challenge_id>', methods=['DELETE'])
@@ -8,6 +8,7 @@ from flask import Blueprint, request, jsonify
 from ctf import auth
 from ctf.models import Difficulty, Challenge
 from ctf.utils import has_json_args
+from ctf.etags import conditional_get
 from ctf.constants import collision, not_found
 
 difficulties_bp = Blueprint("difficulties", __name__)
@@ -15,6 +16,7 @@ difficulties_bp = Blueprint("difficulties", __name__)
 
 @difficulties_bp.route('', methods=['GET'])
 @auth.login_required
+@conditional_get
 def all_difficulties():
     """
     Get all difficulties
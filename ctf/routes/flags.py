@@ -4,10 +4,12 @@ Contains routes pertaining to the retrieval and creation of flags
 """
 
 from flask import Blueprint, request, jsonify
+from sqlalchemy.exc import IntegrityError
 
-from ctf import auth
-from ctf.models import Flag, Challenge, Solved, Hint, UsedHint
-from ctf.utils import delete_flag, has_json_args, expose_userinfo, is_ctf_admin
+from ctf import auth, db
+from ctf.models import Flag, Challenge, Hint, flag_digest
+from ctf.utils import delete_flag, has_json_args, expose_userinfo, is_ctf_admin, get_progress
+from ctf.etags import conditional_get
 from ctf.constants import not_found, collision, not_authorized, no_username
 
 flags_bp = Blueprint('flags', __name__)
@@ -16,6 +18,7 @@ flags_bp = Blueprint('flags', __name__)
 @flags_bp.route('/challenges/<int:challenge_id>/flags', methods=['GET'])
 @auth.login_required
 @expose_userinfo
+@conditional_get
 def all_flags(challenge_id: int, **kwargs):
     """
     Operations relating to flags
@@ -33,23 +36,22 @@ def all_flags(challenge_id: int, **kwargs):
     if not current_username:
         return no_username()
 
-    used_hints = set(
-        used_hint.hint_id for used_hint in UsedHint.query.filter_by(username=current_username).all()
-    )
+    progress = get_progress(current_username)
+    is_creator = challenge.submitter == current_username
     flags = {
         flag.id: flag.to_dict() for flag in Flag.query.filter_by(challenge_id=challenge_id).all()
     }
+    hints = {flag: {} for flag in flags}
+    if flags:
+        for hint in Hint.query.filter(Hint.flag_id.in_(list(flags))).all():
+            hints[hint.flag_id][hint.id] = hint.to_dict()
     for flag in flags:
-        is_creator = challenge.submitter == current_username
-        if not is_creator and \
-           not Solved.query.filter_by(username=current_username, flag_id=flags[flag]['id']).first():
+        if not is_creator and flags[flag]['id'] not in progress.solved:
             del flags[flag]['flag']
-        flags[flag]['hints'] = {
-            hint.id: hint.to_dict() for hint in Hint.query.filter_by(flag_id=flag).all()
-        }
+        flags[flag]['hints'] = hints[flag]
         for hint in flags[flag]['hints'].values():
-            if not is_creator and hint['id'] not in used_hints:
-                del flags[flag]['hints'][hint['id']]['hint']
+            if not is_creator and hint['id'] not in progress.used_hints:
+                del hint['hint']
     return jsonify(flags), 200
 
 
@@ -66,7 +68,13 @@ def add_flag(challenge_id: int, **kwargs):
         return not_found()
 
     data = request.get_json()
-    flag_exists = Flag.query.filter_by(challenge_id=challenge_id, flag=data['flag']).first()
+    if not isinstance(data['flag'], str):
+        return jsonify({
+            'status': "error",
+            'message': "The flag must be a string"
+        }), 400
+    flag_exists = Flag.query.filter_by(challenge_id=challenge_id,
+                                       digest=flag_digest(data['flag'])).first()
     if flag_exists:
         return collision()
 
@@ -77,7 +85,12 @@ def add_flag(challenge_id: int, **kwargs):
     if current_username != challenge.submitter and not is_ctf_admin(groups):
         return not_authorized()
 
-    new_flag = Flag.create(data['point_value'], data['flag'], challenge_id)
+    # A flag added concurrently still trips the unique (challenge_id, digest) index
+    try:
+        new_flag = Flag.create(data['point_value'], data['flag'], challenge_id)
+    except IntegrityError:
+        db.session.rollback()
+        return collision()
     return jsonify(new_flag), 201
 
 
@@ -4,10 +4,13 @@ Contains routes relating to hints
 """
 
 from flask import Blueprint, request, jsonify
+from sqlalchemy.exc import IntegrityError
 
-from ctf import auth
-from ctf.models import Hint, Flag, UsedHint, Solved
-from ctf.utils import delete_hint, has_json_args, expose_userinfo, is_ctf_admin, get_user_score
+from ctf import auth, db
+from ctf.models import Hint, Flag
+from ctf.utils import delete_hint, has_json_args, expose_userinfo, is_ctf_admin, get_progress
+from ctf.etags import conditional_get
+from ctf.scoreboard import buy_hint
 from ctf.constants import not_found, not_authorized, no_username, collision
 
 hints_bp = Blueprint('hints', __name__)
@@ -17,6 +20,7 @@ hints_bp = Blueprint('hints', __name__)
 @hints_bp.route('/flags/<int:flag_id>/hints', methods=['GET'])
 @auth.login_required
 @expose_userinfo
+@conditional_get
 def all_hints(challenge_id: int, flag_id: int, **kwargs):
     # pylint: disable=unused-argument
     """
@@ -35,9 +39,9 @@ def all_hints(challenge_id: int, flag_id: int, **kwargs):
     # Delete a hint's data if a user hasn't unlocked it
     hints = [hint.to_dict() for hint in Hint.query.filter_by(flag_id=flag_id).all()]
     is_flag_creator = flag.challenge.submitter == current_username
+    progress = get_progress(current_username)
     for hint in hints:
-        if not is_flag_creator and \
-           not UsedHint.query.filter_by(hint_id=hint['id'], username=current_username).first():
+        if not is_flag_creator and hint['id'] not in progress.used_hints:
             del hint['hint']
     return jsonify(hints), 200
 
@@ -88,8 +92,8 @@ def purchase_hint(challenge_id: int = 0, flag_id: int = 0, hint_id: int = 0, **k
         return no_username()
 
     # Check that the relation doesn't already exist
-    used_hints_check = UsedHint.query.filter_by(hint_id=hint_id, username=current_username).first()
-    if used_hints_check:
+    progress = get_progress(current_username)
+    if hint_id in progress.used_hints:
         return collision()
 
     if current_username == hint.flag.challenge.submitter:
@@ -98,20 +102,27 @@ def purchase_hint(challenge_id: int = 0, flag_id: int = 0, hint_id: int = 0, **k
             'message': "You created this hint!"
         }), 403
 
-    if Solved.query.filter_by(flag_id=hint.flag.id).first():
+    if hint.flag_id in progress.solved:
         return jsonify({
             'status': "error",
             'message': "You already solved the flag associated with this hint!"
         }), 422
 
-    if get_user_score(current_username)[0] - hint.cost < 0:
+    try:
+        new_used_hint = buy_hint(hint, current_username)
+    except IntegrityError:
+        # Another request bought the same hint first
+        db.session.rollback()
+        return collision()
+    if new_used_hint is None:
+        db.session.rollback()
         return jsonify({
             'status': "error",
             'message': "You don't have enough points to purchase this hint!"
         }), 422
-
-    new_used_hint = UsedHint.create(hint_id, current_username)
-    return jsonify(new_used_hint.hint.to_dict()), 201
+    db.session.commit()
+    progress.invalidate()
+    return jsonify(hint.to_dict()), 201
 
 
 @hints_bp.route('/challenges/<int:challenge_id>/flags/<int:flag_id>/hints/<int:hint_id>',
@@ -2,101 +2,186 @@
 
 This module contains the routes that retrieve score for users
 """
+import queue
 from datetime import datetime
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response
 
-from ctf import auth
-from ctf.models import Solved, UsedHint
-from ctf.utils import get_user_score
+from ctf import auth, app
+from ctf.feed import score_feed, issue_stream_ticket, check_stream_ticket
+from ctf.scoreboard import get_scores, get_timelines, leaderboard, top_scores
+from ctf.utils import get_user_score, stream_json, stream_json_array, stream_json_object, \
+    expose_userinfo
+from ctf.constants import not_found, no_username
 
 score_bp = Blueprint('scores', __name__)
 
+DATE_FORMAT = "%Y-%m-%d%H:%M:%S"
+
+
+def parse_date_arg(name: str):
+    """
+    Parses a date URL parameter
+
+    :param name: Name of the URL parameter
+    :return: The date, or None if the parameter wasn't given
+    :raises ValueError: If the date isn't formatted as DATE_FORMAT
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def invalid_date():
+    """
+    Return data for when a date URL parameter is formatted incorrectly
+    """
+    return jsonify({
+        'status': "error",
+        'message': "Date should be formatted as " + DATE_FORMAT
+    }), 400
+
 
 @score_bp.route('', methods=['GET'])
 @auth.login_required
 def get_all_scores():
     """
-    Gets the score for all users
+    Gets the score for all users. Unless 'after' or 'before' is given, users are returned in order
+    of rank.
+
+    When 'limit' is given, the response is instead a list of the highest ranked users in order,
+    each with their 'rank'. Users with the same score are ranked by who solved more flags, then
+    by who reached their score first.
 
     URL Parameters:
         :url_param after: Request scores after this date
         :url_param before: Request scores before this date
-        :url_param limit: Limit the number of user scores that are requested
-    :TODO: Use SQL queries so this is more efficient
+        :url_param limit: Only return this many of the highest ranked users
     """
-    limit = int(request.args.get('limit'))
-    after = request.args.get('after')
-    before = request.args.get('before')
+    limit = request.args.get('limit', default=0, type=int)
+    try:
+        after = parse_date_arg('after')
+        before = parse_date_arg('before')
+    except ValueError:
+        return invalid_date()
 
-    if after:
-        try:
-            after = datetime.strptime(request.args.get('after', ''), "%Y-%m-%d%H:%M:%S")
-        except:
-            return jsonify({
-                'status': "error",
-                'message': "Date should be formatted as %Y-%m-%d%H:%M:%S"
-            }), 400
-    if before:
+    if limit > 0:
+        # The highest ranked users, in order and numbered. Ties go to whoever got there first.
+        if after or before:
+            top = top_scores(get_scores(after, before), limit)
+        else:
+            top = leaderboard.top(limit)
+        return stream_json(stream_json_array(top)), 200
+
+    if not (after or before):
+        # The whole history is kept ranked in memory
+        return stream_json(stream_json_object((entry['username'], {
+            'score': entry['score'],
+            'solved_flags': entry['solved_flags']
+        }) for entry in leaderboard.top())), 200
+
+    # One row per user is read, since the totals are added up by the database
+    return stream_json(stream_json_object((username, {
+        'score': int(score),
+        'solved_flags': int(solved_flags)
+    }) for username, score, solved_flags, _ in get_scores(after, before))), 200
+
+
+@score_bp.route('/timeline', methods=['GET'])
+@auth.login_required
+def get_score_timeline():
+    """
+    Gets how the scores of the highest ranked users grew over time, in buckets of
+    'bucket_seconds'. Each point is the user's score and solved flags at the end of a bucket
+    they scored in, counted from the start of the window.
+
+    URL Parameters:
+        :url_param after: Start the timelines at the bucket containing this date
+        :url_param before: End the timelines at the bucket containing this date
+        :url_param limit: Number of users to return, ranked over the window. Defaults to 10.
+    """
+    limit = min(max(request.args.get('limit', default=10, type=int), 1), 100)
+    try:
+        after = parse_date_arg('after')
+        before = parse_date_arg('before')
+    except ValueError:
+        return invalid_date()
+
+    if after or before:
+        top = top_scores(get_scores(after, before), limit)
+    else:
+        top = leaderboard.top(limit)
+    timelines = get_timelines([entry['username'] for entry in top], after, before)
+    for entry in top:
+        entry['timeline'] = [{
+            'ts': bucket,
+            'score': score,
+            'solved_flags': solved_flags
+        } for bucket, score, solved_flags in timelines[entry['username']]]
+    return jsonify({
+        'bucket_seconds': app.config['SCORE_BUCKET_SECONDS'],
+        'users': top
+    }), 200
+
+
+@score_bp.route('/stream/ticket', methods=['POST'])
+@auth.login_required
+@expose_userinfo
+def create_stream_ticket(**kwargs):
+    """
+    Issues a ticket that opens the score stream for SCORE_STREAM_TICKET_TTL seconds, for clients
+    that can't send an Authorization header to it
+    """
+    current_username = kwargs['userinfo'].get('preferred_username')
+    if not current_username:
+        return no_username()
+    if not app.config['SECRET_KEY']:
+        return jsonify({
+            'status': "error",
+            'message': "Stream tickets aren't available, since no secret key is configured"
+        }), 501
+    return jsonify({
+        'ticket': issue_stream_ticket(current_username),
+        'expires_in': app.config['SCORE_STREAM_TICKET_TTL']
+    }), 201
+
+
+@score_bp.route('/stream', methods=['GET'])
+@auth.login_required(optional=True)
+def stream_scores():
+    """
+    Streams scoreboard changes as Server-Sent Events. The first event is a 'snapshot' of every
+    user's entry in rank order. 'scores' events then carry the 'changed' entries and the
+    'removed' usernames, and 'solves' events list new solves as they happen.
+
+    A browser's EventSource can't send the Authorization header, so it can instead pass a
+    'ticket' URL parameter from POST /scores/stream/ticket.
+    """
+    if not auth.current_user() and not check_stream_ticket(request.args.get('ticket', '')):
+        return jsonify({
+            'status': "error",
+            'message': "Not authenticated"
+        }), 401
+
+    subscriber = score_feed.subscribe()
+    heartbeat = app.config['SCORE_STREAM_HEARTBEAT']
+
+    def events():
         try:
-            before = datetime.strptime(request.args.get('before', ''), "%Y-%m-%d%H:%M:%S")
-        except:
-            return jsonify({
-                'status': "error",
-                'message': "Date should be formatted as %Y-%m-%d%H:%M:%S"
-            }), 400
-
-    solved_query = Solved.query
-    hint_query = UsedHint.query
-    if after:
-        solved_query = solved_query.filter(Solved.ts >= after)
-        hint_query = hint_query.filter(UsedHint.ts >= after)
-    if before:
-        solved_query = solved_query.filter(Solved.ts <= before)
-        hint_query = hint_query.filter(UsedHint.ts <= before)
-
-    all_scores = {}
-    for solved in solved_query.all():
-        if solved.username not in all_scores:
-            all_scores[solved.username] = {
-                'score': 0,
-                'solved_flags': 0
-            }
-        all_scores[solved.username]['score'] = all_scores[solved.username]['score'] + \
-            solved.flag.point_value
-        all_scores[solved.username]['solved_flags'] += 1
-    for used_hint in hint_query.all():
-        all_scores[used_hint.username]['score'] = all_scores[used_hint.username]['score'] - \
-            used_hint.hint.cost
-
-    if limit and 0 < limit < len(all_scores):
-        # Get and sort all scores from dictionary
-        scores = [x['score'] for x in all_scores.values()]
-        scores.sort()
-        score_threshold = scores[limit-1]
-        for i in list(all_scores.keys()):
-            if all_scores[i]['score'] < score_threshold:
-                del all_scores[i]
-        if len(all_scores) > limit:
-            # This occurs if the limit and limit+1 person have the same score
-            most_flags = max([x['solved_flags'] for x in all_scores.values() if x['score'] ==
-                              score_threshold])
-            # Delete those who are at the threshold and have fewer than the maximum number of
-            # flags at the threshold
-            for i in list(all_scores.keys()):
-                if all_scores[i]['score'] == score_threshold and \
-                        all_scores[i]['solved_flags'] < most_flags:
-                    del all_scores[i]
-            if len(all_scores) > limit:
-                # This will occur if two people have the same score and number of flags
-                # Delete them at random
-                for i in list(all_scores.keys()):
-                    if all_scores[i]['score'] == score_threshold and \
-                            all_scores[i]['solved_flags'] == most_flags:
-                        del all_scores[i]
-                        break
-
-    return jsonify(all_scores), 200
+            while True:
+                try:
+                    yield subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    # Comments are ignored by clients, but find connections that have gone away
+                    yield ': keep-alive\n\n'
+        finally:
+            score_feed.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 
 @score_bp.route('/<username>', methods=['GET'])
@@ -111,3 +196,22 @@ def get_users_score(username: str):
         'score': score,
         'solved_flags': solved_flags
     }}), 200
+
+
+@score_bp.route('/<username>/rank', methods=['GET'])
+@auth.login_required
+def get_users_rank(username: str):
+    """
+    Gets the rank of a particular user, and the users ranked around them
+
+    URL Parameters:
+        :url_param neighbors: Number of users to return above and below them. Defaults to 2.
+    :param username: Username to retrieve the rank of
+    """
+    neighbors = min(max(request.args.get('neighbors', default=2, type=int), 0), 50)
+    found = leaderboard.rank(username, neighbors)
+    if not found:
+        return not_found()
+    entry, around = found
+    entry['neighbors'] = around
+    return jsonify(entry), 200
@@ -3,11 +3,17 @@
 These API routes are poorly named. They keep a record of who has solved which flags.
 """
 
+from itertools import groupby
+from operator import itemgetter
+
 from flask import Blueprint, jsonify, request
+from sqlalchemy.exc import IntegrityError
 
-from ctf import auth
+from ctf import auth, app, db
 from ctf.models import Solved, Flag, Challenge
-from ctf.utils import has_json_args, expose_userinfo
+from ctf.ratelimit import limit_submissions
+from ctf.utils import has_json_args, expose_userinfo, get_progress, match_flag, stream_json, \
+    stream_json_object
 from ctf.constants import collision, not_found, no_username
 
 solved_bp = Blueprint('solved', __name__)
@@ -25,18 +31,20 @@ def solved_flags(challenge_id: int):
     if not challenge:
         return not_found()
 
-    flags = Flag.query.filter_by(challenge_id=challenge_id).all()
-    response = dict()
+    solutions = db.session.query(Flag.id, Solved.username).outerjoin(
+        Solved, Solved.flag_id == Flag.id).filter(Flag.challenge_id == challenge_id).order_by(
+            Flag.id).yield_per(app.config['STREAM_CHUNK_SIZE'])
 
-    for flag in flags:
-        solved = Solved.query.filter_by(flag_id=flag.id).all()
-        response[flag.id] = [solution.username for solution in solved]
+    def solvers_by_flag():
+        for flag_id, rows in groupby(solutions, key=itemgetter(0)):
+            yield flag_id, [username for _, username in rows if username is not None]
 
-    return jsonify(response), 200
+    return stream_json(stream_json_object(solvers_by_flag())), 200
 
 
 @solved_bp.route('/<int:challenge_id>/solved', methods=['POST'])
 @auth.login_required
+@limit_submissions
 @has_json_args("flag")
 @expose_userinfo
 def solve_flag(challenge_id: int, **kwargs):
@@ -53,7 +61,6 @@ def solve_flag(challenge_id: int, **kwargs):
 
     data = request.get_json()
     flag_attempt = data['flag']
-    flags = Flag.query.filter_by(challenge_id=challenge_id).all()
 
     current_username = kwargs['userinfo'].get('preferred_username')
     if not current_username:
@@ -65,16 +72,18 @@ def solve_flag(challenge_id: int, **kwargs):
             'message': "You created this flag!"
         }), 403
 
-    for flag in flags:
-        if flag.flag == flag_attempt:
-            check_solved = Solved.query.filter_by(flag_id=flag.id,
-                                                  username=current_username).first()
-            if check_solved:
-                return collision()
-
-            Solved.create(flag.id, current_username)
-            return jsonify(challenge.to_dict()), 201
-    return jsonify({
-        'status': "error",
-        'message': "Incorrect flag"
-    }), 400
+    flag_id = match_flag(challenge_id, flag_attempt)
+    if flag_id is None:
+        return jsonify({
+            'status': "error",
+            'message': "Incorrect flag"
+        }), 400
+
+    # The primary key rejects a flag being solved twice, so it isn't looked up beforehand
+    try:
+        Solved.create(flag_id, current_username)
+    except IntegrityError:
+        db.session.rollback()
+        return collision()
+    get_progress(current_username).invalidate()
+    return jsonify(challenge.to_dict()), 201
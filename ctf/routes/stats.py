@@ -0,0 +1,25 @@
+""" CTF - stats.py
+
+Contains a route that reports how the API's in-process caches are performing
+"""
+from flask import Blueprint, jsonify
+
+from ctf import auth
+from ctf.utils import verified_token_cache, userinfo_cache, public_challenge_cache, \
+    presigned_url_cache
+
+stats_bp = Blueprint('stats', __name__)
+
+
+@stats_bp.route('', methods=['GET'])
+@auth.login_required(role=['rtp', 'ctf'])
+def get_stats():
+    """
+    Gets the hit and miss counters of each cache in this worker
+    """
+    return jsonify({
+        'verified_tokens': verified_token_cache.stats(),
+        'userinfo': userinfo_cache.stats(),
+        'public_challenges': public_challenge_cache.stats(),
+        'presigned_urls': presigned_url_cache.stats()
+    }), 200
@@ -0,0 +1,545 @@
+""" CTF - scoreboard.py
+
+Contains the user_scores table, which keeps each user's score so that the scoreboard doesn't have
+to be totalled from every solve and hint purchase, and the score_buckets table, which keeps each
+user's running score at the end of every time bucket they scored in. Both are updated in the same
+transaction as the solve or purchase that changes them, and can be repaired with
+`flask rebuild-scores`.
+"""
+import heapq
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import event, text, func, literal, null, bindparam, DateTime
+from sqlalchemy.orm import Session
+
+from ctf import db, app
+from ctf.cache import table_exists
+from ctf.etags import data_versions, SCORES_KEY
+from ctf.models import Solved, UsedHint, UserScore, ScoreBucket, Flag, Hint
+
+# Dialects that understand INSERT ... ON CONFLICT. Others fall back to totalling every solve.
+UPSERT_DIALECTS = ('postgresql', 'sqlite')
+
+SOLVE_POINTS = "(SELECT point_value FROM flags WHERE id = :flag_id)"
+HINT_COST = "(SELECT cost FROM hints WHERE id = :hint_id)"
+
+# Adds a change to a user's total, creating their row if needed. Concurrent first solves by the
+# same user can't collide because the insert falls through to the update.
+UPDATE_SCORE = (
+    "INSERT INTO user_scores (username, score, solved_flags, last_solve_ts) "
+    "VALUES (:username, :sign * {points}, :sign * :solves, "
+    "(SELECT max(ts) FROM solved WHERE username = :username)) "
+    "ON CONFLICT (username) DO UPDATE SET "
+    "score = user_scores.score + excluded.score, "
+    "solved_flags = user_scores.solved_flags + excluded.solved_flags, "
+    "last_solve_ts = excluded.last_solve_ts"
+)
+
+# Spends points only if the user has enough, so checking and spending them is a single write
+SPEND_SCORE = (
+    "UPDATE user_scores SET score = score - :cost "
+    "WHERE username = :username AND score >= :cost"
+)
+
+# Removes a user's row once they have no solves or purchased hints left, like a rebuild would
+PRUNE_SCORE = (
+    "DELETE FROM user_scores WHERE username = :username "
+    "AND NOT EXISTS (SELECT 1 FROM solved WHERE username = :username) "
+    "AND NOT EXISTS (SELECT 1 FROM used_hints WHERE username = :username)"
+)
+
+# Adds a user's row for a bucket if it's missing, starting from their score in the bucket before
+OPEN_BUCKET = (
+    "INSERT INTO score_buckets (username, bucket, score, solved_flags) VALUES (:username, :bucket, "
+    "COALESCE((SELECT score FROM score_buckets WHERE username = :username AND bucket < :bucket "
+    "ORDER BY bucket DESC LIMIT 1), 0), "
+    "COALESCE((SELECT solved_flags FROM score_buckets WHERE username = :username "
+    "AND bucket < :bucket ORDER BY bucket DESC LIMIT 1), 0)) "
+    "ON CONFLICT (username, bucket) DO NOTHING"
+)
+
+# Adds a change to the running score of a bucket and every bucket after it. Solves almost always
+# land in a user's latest bucket, so this usually touches a single row.
+UPDATE_BUCKETS = (
+    "UPDATE score_buckets SET score = score + :sign * {points}, "
+    "solved_flags = solved_flags + :sign * :solves "
+    "WHERE username = :username AND bucket >= :bucket"
+)
+
+PRUNE_BUCKETS = (
+    "DELETE FROM score_buckets WHERE username = :username "
+    "AND NOT EXISTS (SELECT 1 FROM user_scores WHERE username = :username)"
+)
+
+REBUILD_SCORES = (
+    "INSERT INTO user_scores (username, score, solved_flags, last_solve_ts) "
+    "SELECT username, sum(points), sum(solves), max(solve_ts) FROM ("
+    "SELECT solved.username AS username, flags.point_value AS points, 1 AS solves, "
+    "solved.ts AS solve_ts FROM solved JOIN flags ON flags.id = solved.flag_id "
+    "UNION ALL "
+    "SELECT used_hints.username, -hints.cost, 0, NULL "
+    "FROM used_hints JOIN hints ON hints.id = used_hints.hint_id"
+    ") AS score_events GROUP BY username"
+)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def scores_available(connection) -> bool:
+    """
+    Checks whether the database behind 'connection' has the score tables
+
+    :param connection: A connection to the database
+    """
+    if connection.dialect.name not in UPSERT_DIALECTS:
+        return False
+    return all(table_exists(connection, table)
+               for table in (UserScore.__tablename__, ScoreBucket.__tablename__))
+
+
+def rebuild_scores():
+    """
+    Creates the score tables if they don't exist and recalculates them from every solve and
+    purchased hint
+    """
+    connection = db.session.connection()
+    UserScore.__table__.create(connection, checkfirst=True)
+    ScoreBucket.__table__.create(connection, checkfirst=True)
+    connection.execute(text("DELETE FROM user_scores"))
+    connection.execute(text(REBUILD_SCORES))
+    connection.execute(text("DELETE FROM score_buckets"))
+    chunk = []
+    for username, bucket, score, solved_flags in accumulate_buckets(ordered_events()):
+        chunk.append({'username': username, 'bucket': bucket, 'score': score,
+                      'solved_flags': solved_flags})
+        if len(chunk) == app.config['STREAM_CHUNK_SIZE']:
+            connection.execute(ScoreBucket.__table__.insert(), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(ScoreBucket.__table__.insert(), chunk)
+    db.session.commit()
+    data_versions.bump(SCORES_KEY)
+
+
+def buy_hint(hint: Hint, username: str):
+    """
+    Adds a hint purchase to the session if the user can afford it. The points are checked and
+    spent by one conditional write to their user_scores row, which concurrent purchases wait on,
+    so they can't spend the same points. The caller commits, or rolls back if None is returned.
+
+    Without the user_scores table, the purchase is flushed first and the user's total checked
+    afterwards. Only SQLite, whose writes are serialized, is safe from races that way, so
+    PostgreSQL databases should have the table (`flask rebuild-scores`).
+
+    :param hint: The hint being bought
+    :param username: The user buying it
+    :return: The new UsedHint, or None if the user doesn't have enough points
+    :raises IntegrityError: If the user already bought the hint
+    """
+    used_hint = UsedHint(hint.id, username)
+    if hint.cost > 0 and scores_available(db.session.connection()):
+        spent = db.session.connection().execute(text(SPEND_SCORE),
+                                                {'username': username, 'cost': hint.cost})
+        if spent.rowcount != 1:
+            return None
+        used_hint.prepaid = True
+        db.session.add(used_hint)
+        db.session.flush()
+        return used_hint
+
+    db.session.add(used_hint)
+    db.session.flush()
+    if hint.cost > 0:
+        # The total includes the purchase that was just flushed
+        score = get_scores(usernames=[username]).first()
+        if score is None or score[1] < 0:
+            return None
+    return used_hint
+
+
+def score_events(after: datetime = None, before: datetime = None):
+    """
+    Builds a query of every event that changes a score: one row per solve worth the flag's points,
+    and one row per purchased hint worth minus the hint's cost
+
+    :param after: Only include events at or after this time
+    :param before: Only include events at or before this time
+    :return: Subquery with 'username', 'points', 'solves', 'ts' and 'solve_ts' columns. 'solve_ts'
+        is only set on solves.
+    """
+    solves = db.session.query(
+        Solved.username.label('username'),
+        Flag.point_value.label('points'),
+        literal(1).label('solves'),
+        Solved.ts.label('ts'),
+        Solved.ts.label('solve_ts')
+    ).join(Flag, Solved.flag_id == Flag.id)
+    hints = db.session.query(
+        UsedHint.username.label('username'),
+        (-Hint.cost).label('points'),
+        literal(0).label('solves'),
+        UsedHint.ts.label('ts'),
+        null().label('solve_ts')
+    ).join(Hint, UsedHint.hint_id == Hint.id)
+    if after:
+        solves = solves.filter(Solved.ts >= after)
+        hints = hints.filter(UsedHint.ts >= after)
+    if before:
+        solves = solves.filter(Solved.ts <= before)
+        hints = hints.filter(UsedHint.ts <= before)
+    return solves.union_all(hints).subquery('score_events')
+
+
+def get_scores(after: datetime = None, before: datetime = None, usernames: list = None):
+    """
+    Reads scores from the user_scores table, or adds them up in the database when the table isn't
+    available or only part of the history is asked for. Either way one row per user is returned.
+
+    :param after: Only count solves and hints at or after this time
+    :param before: Only count solves and hints at or before this time
+    :param usernames: Only total the scores of these users
+    :return: Query of (username, score, solved_flags, last_solve_ts) rows
+    """
+    # Running totals can only be used when every solve and hint counts
+    if after is None and before is None and scores_available(db.session.connection()):
+        scores = db.session.query(UserScore.username, UserScore.score, UserScore.solved_flags,
+                                  UserScore.last_solve_ts)
+        if usernames is not None:
+            scores = scores.filter(UserScore.username.in_(usernames))
+        return scores
+
+    events = score_events(after, before)
+    scores = db.session.query(
+        events.c.username,
+        func.sum(events.c.points),
+        func.sum(events.c.solves),
+        func.max(events.c.solve_ts)
+    ).group_by(events.c.username)
+    if usernames is not None:
+        scores = scores.filter(events.c.username.in_(usernames))
+    return scores
+
+
+def update_score(connection, points: str, sign: int, username: str, solves: int,
+                 happened_at: datetime, prune: bool = False, prepaid: bool = False, **params):
+    """
+    Adds a change to a user's row of the user_scores table
+
+    :param connection: The connection the change was written with
+    :param points: SQL expression for the number of points involved
+    :param sign: 1 to add the points and solves, -1 to take them away
+    :param username: The user whose score changed
+    :param solves: Number of solved flags involved
+    :param happened_at: When the solve or purchase happened
+    :param prune: Whether to remove the user's row if they have nothing left to score
+    :param prepaid: Whether the points were already taken from user_scores, so only the buckets
+        should change
+    :param params: Parameters used by 'points'
+    """
+    if scores_available(connection):
+        params = dict(params, sign=sign, username=username, solves=solves,
+                      bucket=bucket_start(happened_at))
+        if not prepaid:
+            connection.execute(text(UPDATE_SCORE.format(points=points)), params)
+        connection.execute(text(OPEN_BUCKET).bindparams(bindparam('bucket', type_=DateTime)),
+                           params)
+        connection.execute(text(UPDATE_BUCKETS.format(points=points)).bindparams(
+            bindparam('bucket', type_=DateTime)), params)
+        if prune:
+            connection.execute(text(PRUNE_SCORE), params)
+            connection.execute(text(PRUNE_BUCKETS), params)
+
+
+@event.listens_for(Solved, 'after_insert')
+def add_solve(mapper, connection, solved):
+    # pylint: disable=unused-argument
+    """
+    Adds a flag's points to the score of the user who solved it
+    """
+    update_score(connection, SOLVE_POINTS, 1, solved.username, 1, solved.ts,
+                 flag_id=solved.flag_id)
+
+
+@event.listens_for(Solved, 'after_delete')
+def remove_solve(mapper, connection, solved):
+    # pylint: disable=unused-argument
+    """
+    Takes a deleted solve's points back from the user's score
+    """
+    update_score(connection, SOLVE_POINTS, -1, solved.username, 1, solved.ts, prune=True,
+                 flag_id=solved.flag_id)
+
+
+@event.listens_for(UsedHint, 'after_insert')
+def add_used_hint(mapper, connection, used_hint):
+    # pylint: disable=unused-argument
+    """
+    Takes a purchased hint's cost from the score of the user who bought it
+    """
+    update_score(connection, HINT_COST, -1, used_hint.username, 0, used_hint.ts,
+                 prepaid=used_hint.prepaid, hint_id=used_hint.hint_id)
+
+
+@event.listens_for(UsedHint, 'after_delete')
+def remove_used_hint(mapper, connection, used_hint):
+    # pylint: disable=unused-argument
+    """
+    Refunds a deleted hint purchase
+    """
+    update_score(connection, HINT_COST, 1, used_hint.username, 0, used_hint.ts, prune=True,
+                 hint_id=used_hint.hint_id)
+
+
+def bucket_start(moment: datetime) -> datetime:
+    """
+    :param moment: A point in time
+    :return: The start of the timeline bucket that 'moment' falls in
+    """
+    width = timedelta(seconds=app.config['SCORE_BUCKET_SECONDS'])
+    return EPOCH + (moment - EPOCH) // width * width
+
+
+def ordered_events(usernames: list = None, before: datetime = None):
+    """
+    :param usernames: Only include the events of these users
+    :param before: Only include events at or before this time
+    :return: Query of (username, points, solves, ts) rows of score events, by user and then time
+    """
+    events = score_events(before=before)
+    rows = db.session.query(events.c.username, events.c.points, events.c.solves, events.c.ts)
+    if usernames is not None:
+        rows = rows.filter(events.c.username.in_(usernames))
+    return rows.order_by(events.c.username, events.c.ts)
+
+
+def accumulate_buckets(events):
+    """
+    Totals score events into each user's running score at the end of every bucket they scored in
+
+    :param events: (username, points, solves, ts) rows, ordered by user and then time
+    :return: Generator of (username, bucket, score, solved_flags) rows
+    """
+    for username, user_events in groupby(events, key=itemgetter(0)):
+        score = solved_flags = 0
+        bucket = None
+        for _, points, solves, happened_at in user_events:
+            start = bucket_start(happened_at)
+            if bucket is not None and start != bucket:
+                yield username, bucket, score, solved_flags
+            bucket = start
+            score += points
+            solved_flags += solves
+        yield username, bucket, score, solved_flags
+
+
+def get_timelines(usernames: list, after: datetime = None, before: datetime = None) -> dict:
+    """
+    Builds the score timelines of users from their running scores at the end of each bucket. The
+    score over a window is the difference between two running scores, so no solve history is
+    added up when reading.
+
+    :param usernames: The users to build the timelines of
+    :param after: Start the timelines at the bucket containing this time
+    :param before: End the timelines at the bucket containing this time
+    :return: Dictionary of each username to a list of (bucket, score, solved_flags) tuples, counted
+        from the start of the window
+    """
+    if scores_available(db.session.connection()):
+        rows = db.session.query(ScoreBucket.username, ScoreBucket.bucket, ScoreBucket.score,
+                                ScoreBucket.solved_flags).filter(
+                                    ScoreBucket.username.in_(usernames))
+        if before:
+            rows = rows.filter(ScoreBucket.bucket <= before)
+        rows = rows.order_by(ScoreBucket.username, ScoreBucket.bucket)
+    else:
+        rows = accumulate_buckets(ordered_events(usernames, before))
+
+    first = bucket_start(after) if after else None
+    timelines = {username: [] for username in usernames}
+    starts = {}
+    for username, bucket, score, solved_flags in rows:
+        if first and bucket < first:
+            # The last running score before the window is subtracted from the ones inside it
+            starts[username] = (score, solved_flags)
+            continue
+        start_score, start_solved_flags = starts.get(username, (0, 0))
+        timelines[username].append((bucket, score - start_score, solved_flags - start_solved_flags))
+    return timelines
+
+
+def top_scores(rows, limit: int) -> list:
+    """
+    Picks the highest ranked users without sorting everyone, ranked like the Leaderboard
+
+    :param rows: (username, score, solved_flags, last_solve_ts) rows of every user
+    :param limit: Number of users to return
+    :return: Entries of the highest ranked users, in order
+    """
+    keys = heapq.nsmallest(limit, (Leaderboard.make_key(*row) for row in rows))
+    return [Leaderboard.make_entry(key, rank) for rank, key in enumerate(keys, 1)]
+
+
+class Leaderboard:
+    """
+    Every user's place on the scoreboard, kept sorted in memory so that ranks are found by
+    bisection. Commits made by this worker only reload the users they changed. Commits made by
+    other workers are noticed through the scores version, and reload the whole board.
+
+    Which commits were made here is known by the scores versions they bumped, rather than by
+    counting them, so that a commit from another worker landing between this worker's bump and
+    its record_commit can't be mistaken for one of this worker's.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._users = {}
+        self._version = None
+        self._changed = set()
+        self._own_versions = set()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(username: str, score: int, solved_flags: int, last_solve_ts: datetime) -> tuple:
+        """
+        :return: Sort key of a user. Higher scores come first, then more solved flags, then
+            whoever solved their last flag earliest.
+        """
+        return -int(score), -int(solved_flags), last_solve_ts is None, last_solve_ts, username
+
+    @staticmethod
+    def make_entry(key: tuple, rank: int) -> dict:
+        """
+        :param key: Sort key of a user
+        :param rank: The user's rank, starting from 1
+        :return: JSON serializable representation of a user's place on the scoreboard
+        """
+        return {
+            'rank': rank,
+            'username': key[4],
+            'score': -key[0],
+            'solved_flags': -key[1]
+        }
+
+    def record_commit(self, usernames: set, version: tuple):
+        """
+        Remembers which users a commit from this worker changed the scores of
+
+        :param usernames: The users whose scores changed
+        :param version: The (epoch, scores version) the commit's bump produced
+        """
+        with self._lock:
+            self._changed.update(usernames)
+            self._own_versions.add(version)
+
+    def top(self, limit: int = None) -> list:
+        """
+        :param limit: Number of users to return. Every user is returned if this is None.
+        :return: The highest ranked users, in order
+        """
+        with self._lock:
+            self._refresh()
+            keys = self._keys if limit is None else self._keys[:limit]
+            return [self.make_entry(key, rank) for rank, key in enumerate(keys, 1)]
+
+    def rank(self, username: str, neighbors: int = 0):
+        """
+        Finds a user's place on the scoreboard
+
+        :param username: The user to find
+        :param neighbors: Number of users to return on either side of them
+        :return: None if the user isn't on the scoreboard, otherwise a tuple of their entry and
+            the entries of the users around them, including their own
+        """
+        with self._lock:
+            self._refresh()
+            key = self._users.get(username)
+            if key is None:
+                return None
+            index = bisect_left(self._keys, key)
+            start = max(index - neighbors, 0)
+            around = [self.make_entry(other, rank) for rank, other in
+                      enumerate(self._keys[start:index + neighbors + 1], start + 1)]
+            return self.make_entry(key, index + 1), around
+
+    def _refresh(self):
+        """
+        Brings the board up to date with the scores version. Must be called holding the lock.
+        """
+        version = (data_versions.epoch, data_versions.get(SCORES_KEY))
+        if version == self._version:
+            return
+        if self._version is not None and version[0] == self._version[0] and all(
+                (version[0], number) in self._own_versions
+                for number in range(self._version[1] + 1, version[1] + 1)):
+            # Every commit since the last refresh was made by this worker
+            changed = list(self._changed)
+            for username in changed:
+                self._remove(username)
+            self._add(get_scores(usernames=changed))
+        else:
+            self._keys = []
+            self._users = {}
+            self._add(get_scores())
+        self._version = version
+        self._changed = set()
+        self._own_versions = set()
+
+    def _add(self, rows):
+        """
+        Places users on the board
+
+        :param rows: (username, score, solved_flags, last_solve_ts) rows of the users
+        """
+        for row in rows:
+            key = self.make_key(*row)
+            self._users[key[4]] = key
+            insort(self._keys, key)
+
+    def _remove(self, username: str):
+        """
+        Takes a user off the board, if they're on it
+
+        :param username: The user to remove
+        """
+        key = self._users.pop(username, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, key)]
+
+
+leaderboard = Leaderboard()
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_scored_users(session, flush_context):
+    # pylint: disable=unused-argument
+    """
+    Records whose scores the flushed writes change, to be passed to the leaderboard on commit
+    """
+    usernames = session.info.setdefault('scored_usernames', set())
+    for instance in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(instance, (Solved, UsedHint)):
+            usernames.add(instance.username)
+
+
+@event.listens_for(Session, 'after_commit')
+def update_leaderboard(session):
+    """
+    Tells the leaderboard whose scores a committed transaction changed. Runs after
+    etags.bump_written_versions, which was registered first when this module imported etags.
+    """
+    usernames = session.info.pop('scored_usernames', None)
+    versions = session.info.get('bumped_versions', {})
+    if usernames and SCORES_KEY in versions:
+        leaderboard.record_commit(usernames, (versions['epoch'], versions[SCORES_KEY]))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_scored_users(session):
+    """
+    Forgets the users recorded for a transaction that was rolled back
+    """
+    session.info.pop('scored_usernames', None)
@@ -0,0 +1,123 @@
+""" CTF - search.py
+
+Contains the full-text search index over challenges. SQLite databases use an FTS5 table kept in
+sync with the challenges table, PostgreSQL databases use a GIN index over a tsvector expression.
+Any other database falls back to ILIKE matching.
+"""
+from sqlalchemy import DDL, event, text, func, literal_column, Integer, Float
+
+from ctf import db
+from ctf.cache import table_exists
+from ctf.models import Challenge
+
+SEARCH_COLUMNS = ('title', 'description', 'submitter')
+
+CREATE_FTS_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS challenges_fts USING fts5(" + \
+    ", ".join(SEARCH_COLUMNS) + ")"
+CREATE_GIN_INDEX = "CREATE INDEX IF NOT EXISTS ix_challenges_search ON challenges USING GIN (" + \
+    "to_tsvector('english', " + " || ' ' || ".join(SEARCH_COLUMNS) + "))"
+
+
+def search_vector():
+    """
+    :return: The tsvector expression that the PostgreSQL GIN index is built over
+    """
+    document = getattr(Challenge, SEARCH_COLUMNS[0])
+    for column in SEARCH_COLUMNS[1:]:
+        document = document + literal_column("' '") + getattr(Challenge, column)
+    return func.to_tsvector(literal_column("'english'"), document)
+
+
+def search_available(connection) -> bool:
+    """
+    Checks whether the database behind 'connection' has a full-text index
+
+    :param connection: A connection to the database
+    """
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        return table_exists(connection, 'challenges_fts')
+    return dialect == 'postgresql'
+
+
+def search_challenges(challenges, search_query: str):
+    """
+    Filters a Challenge query down to the challenges matching a search
+
+    :param challenges: The Challenge query to filter
+    :param search_query: The terms the user searched for
+    :return: Tuple of the filtered query, and a column to order by for relevance (or None)
+    """
+    connection = db.session.connection()
+    if search_available(connection):
+        if connection.dialect.name == 'sqlite':
+            # Quote every term so FTS5 query syntax in the search is matched literally
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in search_query.split())
+            if not match:
+                return challenges, None
+            matches = text(
+                "SELECT rowid AS challenge_id, bm25(challenges_fts) AS score FROM challenges_fts "
+                "WHERE challenges_fts MATCH :match"
+            ).bindparams(match=match).columns(challenge_id=Integer, score=Float).alias('matches')
+            challenges = challenges.join(matches, matches.c.challenge_id == Challenge.id)
+            # bm25 scores are lower for better matches
+            return challenges, matches.c.score.asc()
+        tsquery = func.plainto_tsquery(literal_column("'english'"), search_query)
+        challenges = challenges.filter(search_vector().op('@@')(tsquery))
+        return challenges, func.ts_rank(search_vector(), tsquery).desc()
+
+    return challenges.filter(
+        getattr(Challenge, 'description').ilike(f'%{search_query}%') |
+        getattr(Challenge, 'title').ilike(f'%{search_query}%') |
+        getattr(Challenge, 'submitter').ilike(f'%{search_query}%')
+    ), None
+
+
+def rebuild_search_index():
+    """
+    Creates the full-text index if it doesn't exist and repopulates it from the challenges table
+    """
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        connection.execute(text(CREATE_FTS_TABLE))
+        connection.execute(text("DELETE FROM challenges_fts"))
+        connection.execute(text(
+            "INSERT INTO challenges_fts(rowid, " + ", ".join(SEARCH_COLUMNS) + ") " +
+            "SELECT id, " + ", ".join(SEARCH_COLUMNS) + " FROM challenges"))
+    elif dialect == 'postgresql':
+        connection.execute(text(CREATE_GIN_INDEX))
+    db.session.commit()
+
+
+@event.listens_for(Challenge, 'after_insert')
+@event.listens_for(Challenge, 'after_update')
+def index_challenge(mapper, connection, challenge):
+    # pylint: disable=unused-argument
+    """
+    Adds or replaces a challenge in the FTS5 table, in the same transaction that wrote it
+    """
+    if connection.dialect.name == 'sqlite' and search_available(connection):
+        values = {column: getattr(challenge, column) for column in SEARCH_COLUMNS}
+        values['id'] = challenge.id
+        connection.execute(text("DELETE FROM challenges_fts WHERE rowid = :id"), values)
+        connection.execute(text(
+            "INSERT INTO challenges_fts(rowid, " + ", ".join(SEARCH_COLUMNS) + ") " +
+            "VALUES (:id, " + ", ".join(":" + column for column in SEARCH_COLUMNS) + ")"), values)
+
+
+@event.listens_for(Challenge, 'after_delete')
+def unindex_challenge(mapper, connection, challenge):
+    # pylint: disable=unused-argument
+    """
+    Removes a deleted challenge from the FTS5 table, in the same transaction that deleted it
+    """
+    if connection.dialect.name == 'sqlite' and search_available(connection):
+        connection.execute(text("DELETE FROM challenges_fts WHERE rowid = :id"),
+                           {'id': challenge.id})
+
+
+event.listen(Challenge.__table__, 'after_create',
+             DDL(CREATE_FTS_TABLE).execute_if(dialect='sqlite'))
+event.listen(Challenge.__table__, 'after_create',
+             DDL(CREATE_GIN_INDEX).execute_if(dialect='postgresql'))
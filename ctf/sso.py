@@ -0,0 +1,256 @@
+""" CTF - sso.py
+
+Contains the helpers used to talk to the configured OpenID Connect SSO
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from jwt.algorithms import RSAAlgorithm
+
+from ctf import app
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling the SSO while its circuit breaker is open"""
+
+
+class SSOClient:  # pylint: disable=too-many-instance-attributes
+    """
+    Shared keep-alive HTTP client for SSO traffic. Enforces timeouts, stops calling the SSO for a
+    while after repeated failures, and coalesces concurrent identical requests.
+    """
+
+    def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 10,
+                 pool_size: int = 10, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        Creates an SSOClient
+
+        :param connect_timeout: Seconds to wait for a connection to the SSO
+        :param read_timeout: Seconds to wait for the SSO to respond
+        :param pool_size: Number of keep-alive connections to hold per host
+        :param failure_threshold: Consecutive failures after which the circuit opens
+        :param reset_timeout: Seconds the circuit stays open before a trial request is let through
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._failures = 0
+        self._open_until = 0
+        self._trial_running = False
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a GET request to the SSO through the circuit breaker
+
+        :param url: URL to request
+        :param kwargs: Extra arguments for requests, such as headers
+        :return: The response
+        :raises CircuitOpenError: If the SSO has been failing and isn't being called right now
+        """
+        self._before_request()
+        try:
+            response = self.session.get(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            self._record(False)
+            raise
+        self._record(response.status_code < 500)
+        return response
+
+    def get_json(self, key: str, url: str, **kwargs):
+        """
+        Sends a GET request and decodes its JSON body. While a request with the same key is in
+        flight, other callers wait for and share its result instead of sending their own.
+
+        :param key: Identifies identical requests, such as a digest of the token being sent
+        :param url: URL to request
+        :param kwargs: Extra arguments for requests, such as headers
+        :return: The decoded JSON body
+        :raises requests.HTTPError: If the SSO didn't respond with a 2xx status, so that an error
+            body is never mistaken for, or cached as, the data asked for
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            response = self.get(url, **kwargs)
+            if not 200 <= response.status_code < 300:
+                raise requests.HTTPError(
+                    "The SSO responded with {}".format(response.status_code), response=response)
+            call['result'] = response.json()
+            return call['result']
+        except Exception as request_error:
+            call['error'] = request_error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call['done'].set()
+
+    def _before_request(self):
+        """
+        Raises CircuitOpenError unless the circuit is closed, or this is the one trial request
+        allowed through once the reset timeout has passed
+        """
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return
+            if time.time() < self._open_until or self._trial_running:
+                raise CircuitOpenError("The SSO is unavailable")
+            self._trial_running = True
+
+    def _record(self, success: bool):
+        """
+        Updates the circuit breaker with the outcome of a request
+        """
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.time() + self.reset_timeout
+
+
+class KeyProvider:  # pylint: disable=too-many-instance-attributes
+    """Lazily loads the SSO's signing keys and keeps them cached by 'kid'"""
+
+    def __init__(self, client: SSOClient, jwks_uri: str = None, key_file: str = None,
+                 refresh_interval: float = 3600, min_refresh_interval: float = 30):
+        """
+        Creates a KeyProvider. Nothing is loaded until a key is first requested.
+
+        :param client: The client used to fetch the JWKS URI
+        :param jwks_uri: URI of the SSO's JWKS document
+        :param key_file: Local PEM or JWKS file to use instead of the JWKS URI
+        :param refresh_interval: Seconds between background refreshes of the JWKS URI
+        :param min_refresh_interval: Minimum seconds between refreshes caused by an unknown 'kid'
+        """
+        self.client = client
+        self.jwks_uri = jwks_uri
+        self.key_file = key_file
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = None
+        self._last_refresh = 0
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def get_key(self, kid: str = None):
+        """
+        Returns the key that should verify a token signed with 'kid'. An unknown 'kid' causes one
+        re-fetch of the JWKS URI, in case the SSO has rotated its keys.
+
+        :param kid: The 'kid' from the token's header
+        :return: The verification key, or None if no key matches
+        """
+        if self._keys is None:
+            self.refresh()
+            self._start_refresher()
+        key = self._find_key(kid)
+        if key is None and not self.key_file and \
+                time.time() - self._last_refresh >= self.min_refresh_interval:
+            self.refresh()
+            key = self._find_key(kid)
+        return key
+
+    def refresh(self):
+        """
+        Reloads the keys from the key file or the JWKS URI. The keys already loaded are kept if
+        the reload fails or finds no keys, so a bad response from the SSO can't lock everyone out.
+        """
+        with self._lock:
+            self._last_refresh = time.time()
+            if self.key_file:
+                with open(self.key_file, 'rb') as key_file:
+                    keys = parse_keys(key_file.read())
+            elif self.jwks_uri:
+                response = self.client.get(self.jwks_uri)
+                response.raise_for_status()
+                keys = parse_keys(response.content)
+            else:
+                keys = {}
+            if keys or self._keys is None:
+                self._keys = keys
+
+    def _find_key(self, kid: str):
+        """
+        Looks up a loaded key. A key without a 'kid', like a PEM key, matches any token.
+        """
+        keys = self._keys or {}
+        if kid in keys:
+            return keys[kid]
+        if None in keys:
+            return keys[None]
+        if kid is None and len(keys) == 1:
+            return next(iter(keys.values()))
+        return None
+
+    def _start_refresher(self):
+        """
+        Starts the background thread that periodically refreshes keys from the JWKS URI
+        """
+        with self._lock:
+            if self._refresher or self.key_file or not self.jwks_uri:
+                return
+            self._refresher = threading.Thread(target=self._refresh_forever, daemon=True)
+            self._refresher.start()
+
+    def _refresh_forever(self):
+        """
+        Refreshes keys every refresh_interval seconds. Runs in the refresher thread.
+        """
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as refresh_error:  # pylint: disable=broad-except
+                print(refresh_error)
+
+
+def parse_keys(data: bytes) -> dict:
+    """
+    Parses a PEM public key, a JWKS document, or a Keycloak realm document into verification keys
+
+    :param data: Raw contents of the key document
+    :return: Dictionary of 'kid' to verification key. A PEM key is stored under None.
+    """
+    data = data.strip()
+    if data.startswith(b"-----BEGIN"):
+        return {None: data}
+    document = json.loads(data)
+    if 'public_key' in document:
+        return {None: b"-----BEGIN PUBLIC KEY-----\n" + bytes(document['public_key'], 'UTF-8') +
+                      b"\n-----END PUBLIC KEY-----"}
+    keys = {}
+    for jwk in document.get('keys', []):
+        if jwk.get('kty') == 'RSA' and jwk.get('use', 'sig') == 'sig':
+            keys[jwk.get('kid')] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+    return keys
+
+
+sso_client = SSOClient(connect_timeout=app.config['SSO_CONNECT_TIMEOUT'],
+                       read_timeout=app.config['SSO_READ_TIMEOUT'],
+                       pool_size=app.config['SSO_POOL_SIZE'],
+                       failure_threshold=app.config['SSO_FAILURE_THRESHOLD'],
+                       reset_timeout=app.config['SSO_RESET_TIMEOUT'])
+key_provider = KeyProvider(sso_client,
+                           jwks_uri=app.config['OIDC_JWKS_URI'],
+                           key_file=app.config['OIDC_KEY_FILE'],
+                           refresh_interval=app.config['OIDC_KEY_REFRESH_INTERVAL'])
@@ -2,29 +2,83 @@
 
 Contains useful functions used across many parts of the API
 """
+import binascii
+import hmac
+import json
 import os
+import threading
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 from functools import wraps
 
-import requests
-from flask import request, jsonify
+from flask import request, jsonify, g, has_request_context, Response, stream_with_context
+from flask import json as flask_json
 import jwt
+from sqlalchemy import inspect, text
 from werkzeug.utils import secure_filename
 
 from ctf import db, auth, app, s3
-from ctf.models import UsedHint, Hint, Solved, Flag, ChallengeTag, Challenge
-from ctf.constants import CTF_ADMINS, missing_body_parts
+from ctf.cache import TTLCache, token_digest
+from ctf.sso import key_provider, sso_client
+from ctf.etags import data_versions, DATA_KEY
+from ctf.scoreboard import get_scores
+from ctf.models import UsedHint, Hint, Solved, Flag, ChallengeTag, Challenge, flag_digest
+from ctf.constants import CTF_ADMINS, TOKEN_ONLY_CLAIMS, missing_body_parts
+
+# Maps the fields of challenge data to the Challenge columns they come from
+CHALLENGE_COLUMNS = {
+    'id': 'id',
+    'difficulty': 'difficulty_name',
+    'category': 'category_name',
+    'title': 'title',
+    'description': 'description',
+    'author': 'author',
+    'submitter': 'submitter',
+    'ts': 'ts',
+    'filename': 'filename'
+}
+CHALLENGE_FIELDS = set(CHALLENGE_COLUMNS) | {'tags', 'download', 'flags', 'hints'}
+
+# Tokens are only cached until their 'exp' claim, so the TTL is just an upper bound
+verified_token_cache = TTLCache(maxsize=app.config['VERIFIED_TOKEN_CACHE_SIZE'], ttl=86400)
+userinfo_cache = TTLCache(maxsize=app.config['USERINFO_CACHE_SIZE'],
+                          ttl=app.config['USERINFO_CACHE_TTL'],
+                          stale_ttl=app.config['USERINFO_CACHE_STALE'])
+presigned_url_cache = TTLCache(maxsize=app.config['PRESIGNED_URL_CACHE_SIZE'])
+# Keyed by (challenge id, data version), so writes invalidate entries in every worker
+public_challenge_cache = TTLCache(maxsize=app.config['PUBLIC_CHALLENGE_CACHE_SIZE'],
+                                  ttl=app.config['PUBLIC_CHALLENGE_CACHE_TTL'])
+# Keyed by (challenge id, data version), so creating or deleting a flag invalidates entries
+flag_cache = TTLCache(maxsize=app.config['FLAG_CACHE_SIZE'], ttl=3600)
 
 
 @auth.verify_token
 def verify_token(token):
     """
-    Verifies that the given token came from a configured OIDC provider
+    Verifies that the given token came from a configured OIDC provider. Tokens that were already
+    verified are served from the verified token cache until they expire.
 
     :param token: Token passed in the authorization header
     :return: The decoded payload
     """
+    if not token:
+        return None
+    key = token_digest(token)
+    claims = verified_token_cache.get(key)
+    if claims is not None:
+        g.token = token
+        g.token_claims = claims
+        return token
     try:
-        if jwt.decode(token, app.config['OIDC_PUBLIC_KEY'], algorithms='RS256'):
+        public_key = key_provider.get_key(jwt.get_unverified_header(token).get('kid'))
+        if public_key is None:
+            return None
+        claims = jwt.decode(token, public_key, algorithms='RS256')
+        if claims:
+            if claims.get('exp'):
+                verified_token_cache.set(key, claims, expires_at=claims['exp'])
+            g.token = token
+            g.token_claims = claims
             return token
     except Exception as jwt_error:
         print(jwt_error)
@@ -44,27 +98,127 @@ def get_user_roles(user: str):
 
 
 def get_userinfo(token: str) -> dict:
+    """
+    Returns the userinfo for a token. Uses the token's own claims when they're sufficient,
+    otherwise the userinfo cache, and only calls the SSO when neither has it.
+
+    :param token: The authorization header to be sent
+    :return: The information describing the current user
+    """
+    if app.config['OIDC_CLAIMS_IDENTITY']:
+        claims = get_token_claims(token)
+        if claims and claims.get('preferred_username') and 'groups' in claims:
+            return apply_ctf_groups({
+                claim: value for claim, value in claims.items() if claim not in TOKEN_ONLY_CLAIMS
+            })
+
+    key = token_digest(token)
+    cached = userinfo_cache.lookup(key)
+    if cached:
+        userinfo, fresh = cached
+        if not fresh and userinfo_cache.claim_refresh(key):
+            threading.Thread(
+                target=refresh_userinfo,
+                args=(token, key, app.config['OIDC_USERINFO_ENDPOINT'])
+            ).start()
+        return copy_userinfo(userinfo)
+
+    userinfo = fetch_userinfo(token, app.config['OIDC_USERINFO_ENDPOINT'])
+    userinfo_cache.set(key, userinfo, expires_at=get_token_expiry(token))
+    return copy_userinfo(userinfo)
+
+
+def fetch_userinfo(token: str, endpoint: str) -> dict:
     """
     Calls the configured SSO userinfo endpoint and returns the data from there
 
     :param token: The authorization header to be sent
+    :param endpoint: The SSO userinfo endpoint
     :return: The information describing the current user
     """
     headers = {
         "Authorization": "Bearer " + token
     }
-    userinfo = requests.get(app.config['OIDC_USERINFO_ENDPOINT'], headers=headers).json()
+    userinfo = sso_client.get_json(token_digest(token), endpoint, headers=headers)
+    # Coalesced callers share the decoded body, so adjust a copy of it
+    return apply_ctf_groups(dict(userinfo))
+
+
+def apply_ctf_groups(userinfo: dict) -> dict:
+    """
+    Grants the 'ctf' group to the users in CTF_ADMINS, and only to them
+
+    :param userinfo: Userinfo or token claims with 'preferred_username' and 'groups'
+    :return: The userinfo with its groups adjusted
+    """
     current_username = userinfo.get('preferred_username')
 
     # Just in case an actual role called "ctf" exists...
     # TODO: Get an actual role created for this
-    userinfo['groups'] = [group for group in userinfo['groups'] if group != 'ctf']
+    userinfo['groups'] = [group for group in userinfo.get('groups', []) if group != 'ctf']
 
     if current_username in CTF_ADMINS:
         userinfo['groups'].append('ctf')
     return userinfo
 
 
+def refresh_userinfo(token: str, key: str, endpoint: str):
+    """
+    Re-fetches a stale userinfo cache entry. Meant to be run in a background thread.
+
+    :param token: The token the entry belongs to
+    :param key: The cache key of the entry
+    :param endpoint: The SSO userinfo endpoint
+    """
+    try:
+        userinfo_cache.set(key, fetch_userinfo(token, endpoint),
+                           expires_at=get_token_expiry(token))
+    except Exception as refresh_error:  # pylint: disable=broad-except
+        print(refresh_error)
+    finally:
+        userinfo_cache.release_refresh(key)
+
+
+def copy_userinfo(userinfo: dict) -> dict:
+    """
+    Copies cached userinfo so callers can modify it without changing the cache
+
+    :param userinfo: The cached userinfo
+    :return: A copy of the userinfo
+    """
+    userinfo = dict(userinfo)
+    userinfo['groups'] = list(userinfo.get('groups', []))
+    return userinfo
+
+
+def get_token_claims(token: str):
+    """
+    Returns the claims that verify_token decoded from a token during this request
+
+    :param token: The token the claims should belong to
+    :return: The decoded claims, or None if this token wasn't verified in this request
+    """
+    if has_request_context() and g.get('token') == token:
+        return g.get('token_claims')
+    return None
+
+
+def get_token_expiry(token: str):
+    """
+    Reads the 'exp' claim of a token that has already been verified
+
+    :param token: The token to read
+    :return: The unix time the token expires at, or None if it can't be determined
+    """
+    claims = get_token_claims(token)
+    if claims is not None:
+        return claims.get('exp')
+    try:
+        return jwt.decode(token, verify=False).get('exp')
+    except jwt.InvalidTokenError:
+        return None
+
+
 @auth.error_handler
 def auth_error(status):
     """
@@ -258,36 +412,412 @@ def delete_challenge_tags(challenge_id: int):
     db.session.commit()
 
 
-def get_all_challenge_data(challenge_id: int, current_user: str):
+def get_challenges_data(challenges: list, current_user: str, fields: set = None) -> list:
+    """
+    Gets the data of many Challenges at once, along with their tags, flags, and the hints
+    associated with those flags. Uses the same number of queries no matter how many Challenges
+    there are, and none at all for Challenges in the public challenge cache.
+
+    :param challenges: The Challenges to get the data of
+    :param current_user: Flags and hints are redacted unless this user solved, bought or made them
+    :param fields: Only include these fields (see parse_challenge_fields). Everything if None.
+    :return: List of challenge data, in the same order as 'challenges'
+    """
+    if not challenges:
+        return []
+    if fields is not None and not fields & {'flags', 'hints'}:
+        return project_challenges(challenges, fields)
+
+    public = get_public_challenges(challenges)
+    progress = get_progress(current_user)
+    returnval = [
+        redact_challenge(public[challenge.id], progress, challenge.submitter == current_user)
+        for challenge in challenges
+    ]
+    if fields is not None:
+        returnval = [select_challenge_fields(data, fields) for data in returnval]
+    return returnval
+
+
+def iter_challenges_data(challenges, current_user: str, fields: set = None):
+    """
+    Yields the data of Challenges as they're read, assembling STREAM_CHUNK_SIZE of them at a time
+    with get_challenges_data so memory use doesn't grow with the number of Challenges
+
+    :param challenges: Iterable of Challenges, such as a query using yield_per()
+    :param current_user: Flags and hints are redacted unless this user solved, bought or made them
+    :param fields: Only include these fields. Everything if None.
+    """
+    chunk = []
+    for challenge in challenges:
+        chunk.append(challenge)
+        if len(chunk) >= app.config['STREAM_CHUNK_SIZE']:
+            yield from get_challenges_data(chunk, current_user, fields)
+            chunk = []
+    yield from get_challenges_data(chunk, current_user, fields)
+
+
+def stream_json_array(items):
+    """
+    Serializes items into a JSON array one item at a time
+
+    :param items: Iterable of JSON serializable items
+    :return: Generator of JSON text
+    """
+    separator = '['
+    for item in items:
+        yield separator + flask_json.dumps(item)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def stream_json_object(items):
+    """
+    Serializes key/value pairs into a JSON object one pair at a time
+
+    :param items: Iterable of (key, value) pairs with JSON serializable values
+    :return: Generator of JSON text
+    """
+    separator = '{'
+    for key, value in items:
+        yield separator + flask_json.dumps(str(key)) + ':' + flask_json.dumps(value)
+        separator = ','
+    yield '{}' if separator == '{' else '}'
+
+
+def stream_json(chunks) -> Response:
+    """
+    Wraps generated JSON text in a streamed response. The request context stays available to the
+    generator, so it can keep reading from the database.
+
+    :param chunks: Generator of JSON text, such as stream_json_array() or stream_json_object()
+    """
+    return Response(stream_with_context(chunks), mimetype='application/json')
+
+
+def parse_challenge_fields(fields: str):
+    """
+    Parses the 'fields' URL parameter of the challenge routes
+
+    :param fields: Comma-separated list of fields, or None
+    :return: Set of the requested fields, or None if every field should be returned, which is
+        also the case when the list is empty
+    :raises ValueError: If an unknown field was requested
+    """
+    if fields is None:
+        return None
+    requested = set(field.strip() for field in fields.split(',') if field.strip())
+    if not requested:
+        return None
+    unknown = requested - CHALLENGE_FIELDS
+    if unknown:
+        raise ValueError("Unknown fields: " + ', '.join(sorted(unknown)))
+    return requested
+
+
+def challenge_load_columns(fields: set):
     """
-    Gets Challenge data, associated flags, and the hints associated with those flags
+    Returns the Challenge columns that must be loaded to build the requested fields
+
+    :param fields: The requested fields, or None for every field
+    :return: List of columns for load_only(), or None if every column is needed
     """
-    # This is a yikes
-    challenge = Challenge.query.filter_by(id=challenge_id).first()
-    is_creator = challenge.submitter == current_user
-    if not challenge:
+    if fields is None or fields & {'flags', 'hints'}:
         return None
-    returnval = challenge.to_dict()
-    if object_name := returnval['filename']:
-        returnval['download'] = create_presigned_url(object_name)
-    solved = set(solved.flag_id for solved in Solved.query.filter_by(username=current_user).all())
-    used = set(
-        used_hint.hint_id for used_hint in UsedHint.query.filter_by(username=current_user).all()
-    )
-    flags = challenge.flags
-    returnval['flags'] = {flag.id: flag.to_dict() for flag in flags}
-    for flag in returnval['flags']:
-        if not is_creator and returnval['flags'][flag]['id'] not in solved:
-            del returnval['flags'][flag]['flag']
-        hints = Hint.query.filter_by(flag_id=flag).all()
-        returnval['flags'][flag]['hints'] = {hint.id: hint.to_dict() for hint in hints}
-        for hint in returnval['flags'][flag]['hints']:
-            if not is_creator and returnval['flags'][flag]['hints'][hint]['id'] not in used:
-                del returnval['flags'][flag]['hints'][hint]['hint']
+    # ts is always needed to order the listing and build cursors
+    names = {'id', 'ts'}
+    names.update(CHALLENGE_COLUMNS[field] for field in fields if field in CHALLENGE_COLUMNS)
+    if 'download' in fields:
+        names.add('filename')
+    return [getattr(Challenge, name) for name in sorted(names)]
+
+
+def project_challenges(challenges: list, fields: set) -> list:
+    """
+    Builds only the requested fields of Challenges that don't include flags or hints, so nothing
+    that wasn't asked for is computed
+
+    :param challenges: The Challenges to get the data of
+    :param fields: The requested fields
+    :return: List of challenge data, in the same order as 'challenges'
+    """
+    tags = {}
+    if 'tags' in fields:
+        tags = get_challenges_tags([challenge.id for challenge in challenges])
 
+    returnval = []
+    for challenge in challenges:
+        challenge_data = {
+            field: getattr(challenge, column) for field, column in CHALLENGE_COLUMNS.items()
+            if field in fields
+        }
+        if 'tags' in fields:
+            challenge_data['tags'] = tags[challenge.id]
+        if 'download' in fields and challenge.filename:
+            challenge_data['download'] = create_presigned_url(challenge.filename)
+        returnval.append(challenge_data)
     return returnval
 
 
+def select_challenge_fields(challenge_data: dict, fields: set) -> dict:
+    """
+    Removes the fields that weren't requested from challenge data made by redact_challenge
+
+    :param challenge_data: Challenge data that may be modified
+    :param fields: The requested fields. Hints are part of the flags, so 'hints' implies 'flags'.
+    """
+    selected = {field: value for field, value in challenge_data.items() if field in fields}
+    selected['flags'] = challenge_data['flags']
+    if 'hints' not in fields:
+        for flag in selected['flags'].values():
+            del flag['hints']
+    return selected
+
+
+def get_challenges_tags(challenge_ids: list) -> dict:
+    """
+    Gets the tags of several challenges in one query
+
+    :param challenge_ids: The challenges whose tags should be returned
+    :return: Dictionary of challenge id to list of tags
+    """
+    tags = {challenge_id: [] for challenge_id in challenge_ids}
+    for tag in ChallengeTag.query.filter(ChallengeTag.challenge_id.in_(challenge_ids)).all():
+        tags[tag.challenge_id].append(tag.tag)
+    return tags
+
+
+def get_challenges_flags(challenge_ids: list) -> dict:
+    """
+    Gets the unredacted flags of several challenges, each with its hints under 'hints', in two
+    queries
+
+    :param challenge_ids: The challenges whose flags should be returned
+    :return: Dictionary of challenge id to dictionary of flag id to flag data
+    """
+    flags = {challenge_id: {} for challenge_id in challenge_ids}
+    all_flags = Flag.query.filter(Flag.challenge_id.in_(challenge_ids)).order_by(Flag.id).all()
+    if all_flags:
+        hints = {}
+        for flag in all_flags:
+            flags[flag.challenge_id][flag.id] = flag.to_dict()
+            flags[flag.challenge_id][flag.id]['hints'] = hints[flag.id] = {}
+        for hint in Hint.query.filter(Hint.flag_id.in_(list(hints))).order_by(Hint.id).all():
+            hints[hint.flag_id][hint.id] = hint.to_dict()
+    return flags
+
+
+def get_public_challenges(challenges: list) -> dict:
+    """
+    Gets the unredacted data of Challenges, shared by every user. Entries are cached until the
+    next write to challenges, flags, hints or tags changes the data version.
+
+    :param challenges: The Challenges to get the data of
+    :return: Dictionary of challenge id to unredacted challenge data. Must not be modified.
+    """
+    version = data_versions.get(DATA_KEY)
+    public = {}
+    missing = []
+    for challenge in challenges:
+        cached = public_challenge_cache.get((challenge.id, version))
+        if cached is None:
+            missing.append(challenge)
+        else:
+            public[challenge.id] = cached
+    if not missing:
+        return public
+
+    challenge_ids = [challenge.id for challenge in missing]
+    tags = get_challenges_tags(challenge_ids)
+    flags = get_challenges_flags(challenge_ids)
+    for challenge in missing:
+        challenge_data = challenge.to_dict(tags=tags[challenge.id])
+        if object_name := challenge_data['filename']:
+            challenge_data['download'] = create_presigned_url(object_name)
+        challenge_data['flags'] = flags[challenge.id]
+        public_challenge_cache.set((challenge.id, version), challenge_data)
+        public[challenge.id] = challenge_data
+    return public
+
+
+def redact_challenge(public: dict, progress, is_creator: bool) -> dict:
+    """
+    Copies unredacted challenge data, removing the flags and hints the user hasn't unlocked
+
+    :param public: Unredacted challenge data from get_public_challenges
+    :param progress: UserProgress of the user the data is for
+    :param is_creator: Whether the user created this challenge, and so can see everything
+    :return: The challenge data to show to this user
+    """
+    challenge_data = dict(public)
+    challenge_data['flags'] = {}
+    for flag_id, public_flag in public['flags'].items():
+        flag = dict(public_flag)
+        if not is_creator and flag_id not in progress.solved:
+            del flag['flag']
+        flag['hints'] = {}
+        for hint_id, public_hint in public_flag['hints'].items():
+            hint = dict(public_hint)
+            if not is_creator and hint_id not in progress.used_hints:
+                del hint['hint']
+            flag['hints'][hint_id] = hint
+        challenge_data['flags'][flag_id] = flag
+    return challenge_data
+
+
+def encode_challenge_cursor(challenge: Challenge) -> str:
+    """
+    Encodes the position of a Challenge in the challenge listing into an opaque cursor
+
+    :param challenge: The last Challenge of a page
+    :return: Cursor that continues the listing after 'challenge'
+    """
+    created = challenge.ts.isoformat() if isinstance(challenge.ts, datetime) else challenge.ts
+    return urlsafe_b64encode(json.dumps([created, challenge.id]).encode('UTF-8')).decode('ascii')
+
+
+def decode_challenge_cursor(cursor: str) -> tuple:
+    """
+    Decodes a cursor made by encode_challenge_cursor
+
+    :param cursor: The cursor passed by the client
+    :return: The (ts, id) of the Challenge the cursor points after
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        created, challenge_id = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(created), int(challenge_id)
+    except (TypeError, UnicodeError, binascii.Error) as cursor_error:
+        raise ValueError("Invalid cursor") from cursor_error
+
+
+def get_flag_digests(challenge_id: int) -> dict:
+    """
+    Gets the digests of a challenge's flags, cached until the data version changes
+
+    :param challenge_id: The challenge whose flags should be returned
+    :return: Dictionary of flag digest to flag id
+    """
+    key = (challenge_id, data_versions.get(DATA_KEY))
+    digests = flag_cache.get(key)
+    if digests is None:
+        # The unique (challenge_id, digest) index keeps each digest to one flag
+        digests = {digest: flag_id for flag_id, digest in db.session.query(Flag.id, Flag.digest)
+                   .filter(Flag.challenge_id == challenge_id, Flag.digest.isnot(None))}
+        flag_cache.set(key, digests)
+    return digests
+
+
+def match_flag(challenge_id: int, flag_attempt: str):
+    """
+    Finds the flag of a challenge that an attempt matches
+
+    :param challenge_id: The challenge the attempt was made on
+    :param flag_attempt: The submitted flag
+    :return: The id of the matching flag, or None if the attempt is incorrect
+    """
+    if not isinstance(flag_attempt, str):
+        return None
+    attempt_digest = flag_digest(flag_attempt)
+    match = None
+    # Every digest is compared in constant time, so how long this takes doesn't depend on how
+    # close the attempt was, or which flag it matched
+    for digest, flag_id in get_flag_digests(challenge_id).items():
+        if hmac.compare_digest(digest, attempt_digest):
+            match = flag_id
+    return match
+
+
+def migrate_flag_digests() -> int:
+    """
+    Adds the digest column and its unique index to the flags table if they're missing, and
+    digests every flag with the current FLAG_DIGEST_KEY
+
+    :return: The number of flags digested
+    :raises ValueError: If a challenge has the same flag twice, naming the flags that clash.
+        Nothing is changed.
+    """
+    connection = db.session.connection()
+    inspector = inspect(connection)
+    if 'digest' not in {column['name'] for column in inspector.get_columns(Flag.__tablename__)}:
+        connection.execute(text("ALTER TABLE flags ADD COLUMN digest TEXT"))
+    rows = db.session.query(Flag.id, Flag.challenge_id, Flag.flag).order_by(Flag.id)
+    flags = [{'flag_id': flag_id, 'challenge_id': challenge_id, 'digest': flag_digest(flag)}
+             for flag_id, challenge_id, flag in rows]
+    clashes = {}
+    for flag in flags:
+        clashes.setdefault((flag['challenge_id'], flag['digest']), []).append(flag['flag_id'])
+    clashes = [flag_ids for flag_ids in clashes.values() if len(flag_ids) > 1]
+    if clashes:
+        db.session.rollback()
+        # The unique index can't be created over them, and only whoever added them can tell
+        # which copy should go
+        raise ValueError("Challenges have the same flag more than once. Delete all but one of "
+                         "each of these groups of flag ids: " +
+                         "; ".join(", ".join(map(str, flag_ids)) for flag_ids in clashes))
+    if flags:
+        connection.execute(text("UPDATE flags SET digest = :digest WHERE id = :flag_id"), flags)
+    digest_index = next(index for index in Flag.__table__.indexes
+                        if index.name == 'ix_flags_challenge_digest')
+    if digest_index.name not in {index['name']
+                                 for index in inspector.get_indexes(Flag.__tablename__)}:
+        digest_index.create(connection)
+    db.session.commit()
+    return len(flags)
+
+
+class UserProgress:
+    """The solved flags and purchased hints of a user, each loaded when first used"""
+
+    def __init__(self, username: str):
+        """
+        :param username: The user whose progress this is
+        """
+        self.username = username
+        self._solved = None
+        self._used_hints = None
+
+    @property
+    def solved(self) -> set:
+        """
+        :return: IDs of the flags this user has solved
+        """
+        if self._solved is None:
+            self._solved = set(flag_id for flag_id, in db.session.query(Solved.flag_id).filter(
+                Solved.username == self.username))
+        return self._solved
+
+    @property
+    def used_hints(self) -> set:
+        """
+        :return: IDs of the hints this user has purchased
+        """
+        if self._used_hints is None:
+            self._used_hints = set(hint_id for hint_id, in db.session.query(
+                UsedHint.hint_id).filter(UsedHint.username == self.username))
+        return self._used_hints
+
+    def invalidate(self):
+        """
+        Forgets everything loaded so far. Should be called after this user solves or buys a hint.
+        """
+        self._solved = None
+        self._used_hints = None
+
+
+def get_progress(username: str) -> UserProgress:
+    """
+    Returns the progress of a user, shared by everything that needs it during the current request
+
+    :param username: The user whose progress should be returned
+    """
+    if 'progress' not in g:
+        g.progress = {}
+    if username not in g.progress:
+        g.progress[username] = UserProgress(username)
+    return g.progress[username]
+
+
 def calculate_score(username: str) -> int:
     """
     Calculates the score for a user. Adds up points from solved challenges, subtracts points from
@@ -346,19 +876,24 @@ def s3_upload_and_create_challenge(title: str, description: str, author: str, su
 
 def delete_s3_object(object_name):
     """
-    Sends request to delete S3 object
+    Sends request to delete S3 object, and forgets its presigned URL
     :param object_name: Name of object to delete
     """
+    presigned_url_cache.pop(object_name)
     s3.delete_object(Bucket=app.config['S3_BUCKET'], Key=object_name)
 
 
 def create_presigned_url(object_name, expiration=10800):
     """
-    Creates a presigned URL for an S3 object
+    Creates a presigned URL for an S3 object. URLs are reused from the presigned URL cache until
+    less than PRESIGNED_URL_MIN_LIFETIME seconds of their lifetime remain.
     :param object_name: object name to generate url for
     :param expiration: How long the link should be valid for
     :return: Presigned URL
     """
+    cached = presigned_url_cache.get(object_name)
+    if cached and cached[0] == expiration:
+        return cached[1]
     try:
         params = {
             'Bucket': app.config['S3_BUCKET'],
@@ -367,6 +902,8 @@ def create_presigned_url(object_name, expiration=10800):
         response = s3.generate_presigned_url('get_object', Params=params, ExpiresIn=expiration)
     except:
         return None
+    presigned_url_cache.set(object_name, (expiration, response),
+                            ttl=expiration - app.config['PRESIGNED_URL_MIN_LIFETIME'])
     return response
 
 
@@ -376,11 +913,7 @@ def get_user_score(username: str):
     :param username: User to retrieve the score of
     :return: Score of the user
     """
-    score = 0
-    solved_flags = 0
-    for solved in Solved.query.filter_by(username=username).all():
-        score += solved.flag.point_value
-        solved_flags += 1
-    for used in UsedHint.query.filter_by(username=username).all():
-        score -= used.hint.cost
-    return score, solved_flags
+    row = get_scores(usernames=[username]).first()
+    if row is None:
+        return 0, 0
+    return int(row[1]), int(row[2])